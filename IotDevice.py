@@ -1,26 +1,42 @@
 # Main file
 
+import asyncio
 import json
+import logging
+import os
+import signal
 import socket
-import sys
 import time
 from datetime import datetime
 
 from air_condition import AirCondition
-from azure import Azure
+from async_runtime import AsyncRuntime
+from cloud_backends import create_backend, create_connection, get_endpoint
 from common import Common
 from device_config import DeviceConfig
-from firebase import Firebase
+from device_log import setup_logging, stop_logging
+from heartbeat import GroupHeartbeat, HeartbeatSender
 from iotversion import *
+from startup import StartupReport, wait_for_network
+from telemetry_queue import GATEWAY_QUEUE_FILE, TelemetryQueue, TelemetryUploader
+from telemetry_reporter import TelemetryReporter
 from temp_reader import Temperature
 from weather import Weather
 
+# Seconds the shared uploader of a gateway waits for the telemetry of the other devices
+GATEWAY_GATHER_DELAY = 2
+
+# How often the request counts and delivery latencies of the hub are logged (s)
+HUB_STATS_INTERVAL = 60*60
+
 # When to report temp alerts
 TEMP_ALERT_LOW  = 7
 TEMP_ALERT_HIGH = 28
 
 # Keys in state and telemetry
 KEY_TELEMETRY_INTERVAL   = "telemetryInterval"
+KEY_TELEMETRY_DEADBAND   = "telemetryDeadband"
+KEY_TELEMETRY_HEARTBEAT  = "telemetryHeartbeat"
 KEY_FALLBACK_DATE        = "fallbackDate"
 KEY_FALLBACK_TEMP        = "fallbackTemp"
 KEY_FALLBACK_ACTIVATED   = "fallbackActivated"
@@ -28,6 +44,9 @@ KEY_BOOT_TIME            = "bootTime"
 KEY_TEMPERATURE_SETPOINT = "tempSetPoint"
 KEY_TEMPERATURE_CURRENT  = "tempCurrent"
 KEY_TELEMETRY_ALERT      = "tempAlert"
+KEY_TEMPERATURE_STALE    = "tempStale"
+KEY_TEMPERATURE_SENSORS  = "tempSensors"
+KEY_TEMPERATURE_SUMMARY  = "tempSummary"
 KEY_TELEMETRY_TIME       = "utctime"
 KEY_OUTDOOR_CONDITIONS   = "outdoor"
 KEY_UPDATE_TIME          = "updateTime"
@@ -36,6 +55,9 @@ KEY_SW_VERSION           = "version"
 KEY_SW_DATE              = "date"
 KEY_IP_ADDRESS           = "ipAddress"
 KEY_AC_STATUS            = "acStatus"
+KEY_AC_CODE              = "acCode"
+KEY_STARTUP              = "startup"
+KEY_HUB_STATS            = "hubStats"
 
 # These values are used as default if keys are lacking
 DESIRED_STATE_TEMPLATE = { 
@@ -43,32 +65,50 @@ DESIRED_STATE_TEMPLATE = {
     KEY_TEMPERATURE_SETPOINT: 21,
     KEY_FALLBACK_DATE:        "2025-01-01",
     KEY_FALLBACK_TEMP:        21,
+    KEY_TELEMETRY_DEADBAND:   0,       # degC, 0 = send every telemetryInterval
+    KEY_TELEMETRY_HEARTBEAT:  60*60,   # Max time between telemetry when deadband is used
 }
 
+# One of several devices hosted by a Gateway shares its weather, cloud connection,
+# heartbeat and telemetry uploader
 class IotDevice:
-    def __init__(self, device_config):
+    def __init__(self, device_config, startup=None, gateway=None):
         self.device_config = device_config
+        self.gateway = gateway
+        self.startup = startup if startup is not None else StartupReport()
         self.reported_temp_alert = False
         self.fallback_activated = False
         self.boot_time = Common.getCurrentUTCTime()
         self.ip_address = self.getIpAddress()
+        self.hub_stats_logged_at = time.monotonic()
 
-        self.weather      = Weather()
+        self.weather      = Weather() if gateway is None else gateway.weather
         self.airCondition = AirCondition(device_config)
-        self.temperature  = Temperature(device_config)
+        self.temperature  = Temperature(device_config, ac_state=self.get_ac_state)
+        self.reporter     = TelemetryReporter()
+        self.heartbeat    = HeartbeatSender() if gateway is None else gateway.heartbeat.member(device_config.deviceid)
+        self.heartbeat.beat("starting")
         
-        if device_config.cloud == "firebase":
-            self.hub = Firebase(self, device_config)
-        elif device_config.cloud == "azure":
-            self.hub = Azure(self, device_config)
+        # Only the SDK of the configured cloud is imported
+        if gateway is None:
+            self.hub = create_backend(device_config.cloud, self, device_config)
+        else:
+            self.hub = create_backend(device_config.cloud, self, device_config, connection=gateway.connection)
+        self.startup.mark("hubReady")
+
+        # All telemetry is stored on disk first and uploaded from there
+        if gateway is None:
+            self.telemetry_queue = TelemetryQueue(max_records=device_config.telemetry_queue_size)
+            self.telemetry_uploader = TelemetryUploader(self.telemetry_queue, self.hub, on_uploaded=self.telemetry_uploaded)
         else:
-            raise Exception("Supported cloud services are 'azure' and 'firebase'. Update 'device_config.json'.")
+            self.telemetry_queue = gateway.telemetry_queue
+            self.telemetry_uploader = gateway.telemetry_uploader
 
         try:
-            with open('desired_state.json', 'r') as f:
+            with open(device_config.state_file, 'r') as f:
                 self.desired = json.load(f)                
         except Exception as e:
-            print("Expection while reading saved desired state: " + str(e))
+            log.warning("Exception while reading saved desired state: " + str(e))
         self.wash_desired()
 
         self.set_fallback_date()
@@ -82,10 +122,9 @@ class IotDevice:
                 self.fallbackDateObject = None
                 self.fallback_activated = False
         except Exception as e:
-            print(e.message)
             self.fallbackDateObject = None
             self.fallback_activated = False
-            print("Fallback date format not YY-MM-DD " + self.desired[KEY_FALLBACK_DATE])
+            log.warning("Fallback date format not YY-MM-DD {}: {}".format(self.desired.get(KEY_FALLBACK_DATE), e))
 
     def wash_desired(self):
         for key, val in DESIRED_STATE_TEMPLATE.items():
@@ -94,6 +133,8 @@ class IotDevice:
         self.desired[KEY_TEMPERATURE_SETPOINT] = self.airCondition.validate_temp(self.desired[KEY_TEMPERATURE_SETPOINT])
         self.desired[KEY_TELEMETRY_INTERVAL] = max(30, self.desired[KEY_TELEMETRY_INTERVAL])
         self.desired[KEY_TELEMETRY_INTERVAL] = min(3600, self.desired[KEY_TELEMETRY_INTERVAL])
+        self.desired[KEY_TELEMETRY_HEARTBEAT] = max(60, min(24*3600, self.desired[KEY_TELEMETRY_HEARTBEAT]))
+        self.reporter.configure(self.desired[KEY_TELEMETRY_DEADBAND], self.desired[KEY_TELEMETRY_HEARTBEAT])
         
     # Callback when the device twin stored in cloud has been updated
     def device_twin_update(self, desired):
@@ -103,7 +144,7 @@ class IotDevice:
         print ("New desired state received: %s" % json.dumps(self.desired, indent=4) )
         try:
             # Save new state to disk (to be read at boot)
-            with open('desired_state.json', 'w') as f:
+            with open(self.device_config.state_file, 'w') as f:
                 json.dump(self.desired, f)                
             # Set new filter time
             self.temperature.set_filter_time(self.desired[KEY_TELEMETRY_INTERVAL])
@@ -113,8 +154,8 @@ class IotDevice:
             self.set_fallback_date()
             # Report new state to HUB
             self.update_reported_state()
-        except Exception as e:
-            print(e)
+        except Exception:
+            log.exception("Device twin update failed")
 
     # Send current state to HUB
     def update_reported_state(self):
@@ -124,22 +165,37 @@ class IotDevice:
         reported[KEY_BOOT_TIME]       = self.boot_time
         reported[KEY_TELEMETRY_ALERT] = self.reported_temp_alert
         reported[KEY_IP_ADDRESS]      = self.ip_address
+        reported[KEY_STARTUP]         = self.startup.get_report()
+        reported[KEY_HUB_STATS]       = self.hub.get_stats()
         if self.airCondition.ac_active:
             reported[KEY_AC_STATUS] = "AC active"
         else:
             reported[KEY_AC_STATUS] = ""
+        # Last IR code sent, may lag tempSetPoint while the IR sender is busy
+        reported[KEY_AC_CODE] = self.airCondition.last_sent_code
         if self.fallback_activated:
             reported[KEY_FALLBACK_ACTIVATED] = "Yes"
         else:
             reported[KEY_FALLBACK_ACTIVATED] = "No"
-        for key in [KEY_TELEMETRY_INTERVAL, KEY_TEMPERATURE_SETPOINT]:
+        for key in [KEY_TELEMETRY_INTERVAL, KEY_TEMPERATURE_SETPOINT, KEY_TELEMETRY_DEADBAND, KEY_TELEMETRY_HEARTBEAT]:
             try:
                 reported[key] = self.desired[key]
             except KeyError:
-                print("State set from HUB lack key '%s'" % key)
+                log.warning("State set from HUB lack key '%s'" % key)
         # Report new state to HUB
         sent = self.hub.update_reported_state(reported)
     
+    # Log the request counts and latencies of the hub every HUB_STATS_INTERVAL
+    def log_hub_stats(self):
+        if time.monotonic() - self.hub_stats_logged_at < HUB_STATS_INTERVAL:
+            return
+        self.hub_stats_logged_at = time.monotonic()
+        log.info("Hub statistics of {}: {}".format(self.device_config.deviceid, json.dumps(self.hub.get_stats())))
+
+    # return (setpoint, AC active), stored with the temp samples
+    def get_ac_state(self):
+        return self.airCondition.get_current_temp(), self.airCondition.ac_active
+
     def get_temp_alert(self, temp):
         low_limit = TEMP_ALERT_LOW
         high_limit = TEMP_ALERT_HIGH
@@ -151,17 +207,97 @@ class IotDevice:
 
     # Sleep for t seconds while every <device_config.temp_sampling> seconds...
     # - checking for temp alerts
+    # - checking for changes to report (report by exception)
     # - kicking hub connection
     # - checking if telemetryInterval has been updated
     def telemetry_sleep(self):
         started_at = time.monotonic() - 2
-        while (time.monotonic() < (started_at + self.desired[KEY_TELEMETRY_INTERVAL])):
+        while (time.monotonic() < (started_at + self.get_telemetry_interval())):
+            self.heartbeat.beat("sleep")
             self.hub.kick()
             time.sleep(device_config.temp_sampling)
             temp_c, temp_m = self.temperature.get()
             alert = self.get_temp_alert(temp_m)
             if alert != self.reported_temp_alert:
                 break
+            change = self.get_report_change(temp_m)
+            if change is not None:
+                print("Reporting telemetry: {}".format(change))
+                break
+
+    # return reason to send telemetry before the interval has passed, or None
+    def get_report_change(self, temp_m):
+        return self.reporter.get_change(temp_m, self.airCondition.currentTemp, self.airCondition.ac_active)
+
+    # Update alert state from the filtered temp and report it to the HUB if changed
+    # return True if changed
+    def update_temp_alert(self, temp_m):
+        current_alert = self.reported_temp_alert
+        self.reported_temp_alert = self.get_temp_alert(temp_m)
+        if current_alert != self.reported_temp_alert:
+            self.update_reported_state()
+            return True
+        return False
+
+    # Set the fallback temp if the fallback date has passed
+    def check_fallback(self):
+        if self.isTimeForFallback():
+            # Have passed automatic fallback time
+            # Set default AC temp
+            print("Fallback activated @ {}".format(datetime.now()))
+            self.desired[KEY_TEMPERATURE_SETPOINT] = self.desired[KEY_FALLBACK_TEMP]
+            self.airCondition.set_temp(self.desired[KEY_FALLBACK_TEMP])
+            self.fallbackDateObject = None
+            self.fallback_activated = True
+            self.update_reported_state()
+
+    def create_telemetry(self, temp_m, weather):
+        tempCurrent = temp_m # Reporting min temp
+
+        telemetry = {}
+        try:
+            telemetry[KEY_TEMPERATURE_SETPOINT] = self.airCondition.get_current_temp()
+        except:
+            # No temperature set point
+            pass
+        telemetry[KEY_TEMPERATURE_CURRENT] = tempCurrent
+        if self.temperature.is_stale():
+            # Sampler has not got a valid reading for a while, tempCurrent is old
+            telemetry[KEY_TEMPERATURE_STALE] = int(self.temperature.get_age())
+        sensors = self.temperature.get_sensors()
+        if len(sensors) > 1:
+            telemetry[KEY_TEMPERATURE_SENSORS] = sensors
+        # All samples since the previous telemetry
+        summary = self.temperature.take_summary()
+        if summary is not None:
+            telemetry[KEY_TEMPERATURE_SUMMARY] = summary
+
+        telemetry[KEY_TELEMETRY_ALERT] = self.reported_temp_alert
+        telemetry[KEY_TELEMETRY_TIME]  = Common.getCurrentUTCTime()
+
+        if weather is not None:
+            telemetry[KEY_OUTDOOR_CONDITIONS] = weather
+
+        self.reporter.reported(temp_m, self.airCondition.currentTemp, self.airCondition.ac_active)
+        self.startup.mark("firstTelemetry")
+        return telemetry
+
+    # Called by the uploader thread after each successful upload
+    def telemetry_uploaded(self):
+        if "firstUpload" not in self.startup.get_report():
+            self.startup.mark("firstUpload")
+            self.startup.log()
+
+    # Store telemetry for upload, with the device id when the queue is shared by a gateway
+    def queue_telemetry(self, telemetry):
+        if self.gateway is None:
+            self.telemetry_queue.put(telemetry)
+        else:
+            self.telemetry_queue.put({"device": self.device_config.deviceid, "telemetry": telemetry})
+
+    # Max time between telemetry, the heartbeat interval in report by exception mode
+    def get_telemetry_interval(self):
+        return self.reporter.get_interval(self.desired[KEY_TELEMETRY_INTERVAL])
 
     def isTimeForFallback(self):
         if self.fallbackDateObject is None:
@@ -187,70 +323,123 @@ class IotDevice:
     # Main loop
     def main_loop(self):
         print ( "Starting IoT Device with ID '{}'".format(self.device_config.deviceid) )
+        self.hub.start()
         self.hub.kick()
+        self.telemetry_uploader.start()
         while True:
             try:
+                self.heartbeat.beat("telemetry")
+                self.log_hub_stats()
                 temp_c, temp_m = self.temperature.get()
-                tempCurrent = temp_m # Reporting min temp
-
-                telemetry = {}
-                try:
-                    telemetry[KEY_TEMPERATURE_SETPOINT] = self.airCondition.get_current_temp()
-                except:
-                    # No temperature set point
-                    pass
-                telemetry[KEY_TEMPERATURE_CURRENT] = tempCurrent
-
-                current_alert = self.reported_temp_alert
-                self.reported_temp_alert = self.get_temp_alert(temp_m)
-                if current_alert != self.reported_temp_alert:
-                    self.update_reported_state()
-                    
-                telemetry[KEY_TELEMETRY_ALERT] = self.reported_temp_alert
-                telemetry[KEY_TELEMETRY_TIME]  = Common.getCurrentUTCTime()  
-                
+                self.update_temp_alert(temp_m)
                 weather = self.weather.get()
-                if weather is not None:
-                    telemetry[KEY_OUTDOOR_CONDITIONS] = weather
-                
-                if self.isTimeForFallback():
-                    # Have passed automatic fallback time
-                    # Set default AC temp
-                    print("Fallback activated @ {}".format(datetime.now()))
-                    self.desired[KEY_TEMPERATURE_SETPOINT] = self.desired[KEY_FALLBACK_TEMP]
-                    self.airCondition.set_temp(self.desired[KEY_FALLBACK_TEMP])
-                    self.fallbackDateObject = None
-                    self.fallback_activated = True
-                    self.update_reported_state()
+                self.check_fallback()
+                telemetry = self.create_telemetry(temp_m, weather)
 
                 # print ( "Send telemetry: %s" % json.dumps(telemetry,indent=4) )
-                sent = self.hub.post_telemetry(telemetry)
-
-                sys.stdout.flush()
+                self.queue_telemetry(telemetry)
 
                 try:
                     self.telemetry_sleep()
                 except Exception as e:
-                    print("Device '{}' has no configured device twin defined".format(self.device_config.deviceid))
+                    log.error("Device '{}' has no configured device twin defined".format(self.device_config.deviceid))
                     if device_config.cloud == "firebase":
                         print("Use portal webpage to add the new device.")
                     else:
                         print("Use e.g. iot_hub_twin_sample.py to create the new device twin")
-                    print(e)
+                    log.error(e)
                     raise KeyboardInterrupt
 
             except KeyboardInterrupt:
                 print ( "IoTHubClient sample stopped by Ctrl-C" )
                 break
                 
-            except Exception as e:
-                print("Top level exception caught:")
-                print(e)
+            except Exception:
+                log.exception("Top level exception caught")
+
+# Hub of the uploader shared by the devices of a gateway.
+# Telemetry of all devices goes to the cloud in one multi-device update.
+class GatewayHub:
+    def __init__(self, hub):
+        self.hub = hub
+
+    def post_telemetry(self, record):
+        return self.post_telemetry_batch([record])
+
+    def post_telemetry_batch(self, records):
+        device_records = []
+        for record in records:
+            if isinstance(record, dict) and "device" in record and "telemetry" in record:
+                device_records.append((record["device"], record["telemetry"]))
+            else:
+                # Dropped, so it does not block the head of the queue
+                log.error("Dropped telemetry record without device id: {}".format(record))
+        if len(device_records) == 0:
+            return True
+        return self.hub.post_device_telemetry_batch(device_records)
+
+# Several devices in one process, one per entry in "devices" of device_config.json.
+# Each device has its own sensor, AC and desired state. The devices share one cloud
+# connection and login, the weather, the telemetry queue and uploader and the asyncio loop.
+class Gateway:
+    def __init__(self, device_config, startup=None):
+        self.device_config = device_config
+        self.weather = Weather()
+        # Beats only while all devices make progress
+        self.heartbeat = GroupHeartbeat(HeartbeatSender())
+        self.connection = create_connection(device_config.cloud)
+        device_configs = device_config.device_configs()
+        self.telemetry_queue = TelemetryQueue(GATEWAY_QUEUE_FILE, max_records=device_config.telemetry_queue_size * len(device_configs))
+        # Set before the devices are created, the devices only keep a reference
+        self.telemetry_uploader = None
+        self.devices = []
+        for config in device_configs:
+            self.devices.append(IotDevice(config, startup, gateway=self))
+        # Telemetry the devices queue at about the same time is uploaded together
+        self.telemetry_uploader = TelemetryUploader(self.telemetry_queue, GatewayHub(self.devices[0].hub),
+                                                    on_uploaded=self.devices[0].telemetry_uploaded, gather_delay=GATEWAY_GATHER_DELAY)
+        for device in self.devices:
+            device.telemetry_uploader = self.telemetry_uploader
+
+    def run(self):
+        print ( "Starting gateway with devices {}".format(", ".join(device.device_config.deviceid for device in self.devices)) )
+        try:
+            asyncio.run(self.main())
+        except KeyboardInterrupt:
+            print ( "IoTHubClient sample stopped by Ctrl-C" )
+
+    async def main(self):
+        await asyncio.gather(*(AsyncRuntime(device).main() for device in self.devices))
+
+# SIGTERM from the supervisor restarting a hung process: keep its last log records
+def terminated(signum, frame):
+    log.error("Terminated by signal {} at {}".format(signum, datetime.now()))
+    stop_logging()
+    os._exit(128 + signum)
 
 # Main program
+startup = StartupReport()
 device_config = DeviceConfig()
-if device_config.logfile is not None:
-    sys.stdout = open(device_config.logfile, "a")
-iotDevice = IotDevice(device_config)
-iotDevice.main_loop()
+setup_logging(device_config.logfile, device_config.log_max_bytes, device_config.log_segments)
+log = logging.getLogger("iot")
+signal.signal(signal.SIGTERM, terminated)
+# Start as soon as the cloud can be reached instead of after a fixed delay.
+# Heartbeats while waiting, so the supervisor does not restart the process during a network outage.
+heartbeat = HeartbeatSender()
+try:
+    if wait_for_network(*get_endpoint(device_config.cloud), deadline=device_config.network_deadline,
+                        on_probe=lambda: heartbeat.beat("network")):
+        startup.mark("networkReady")
+except Exception as e:
+    log.warning("Network readiness not checked: {}".format(e))
+if device_config.devices:
+    if not device_config.async_runtime:
+        log.warning("Gateway mode runs the devices in the asyncio runtime, async_runtime false is ignored")
+    Gateway(device_config, startup).run()
+elif device_config.async_runtime:
+    iotDevice = IotDevice(device_config, startup)
+    AsyncRuntime(iotDevice).run()
+else:
+    iotDevice = IotDevice(device_config, startup)
+    iotDevice.main_loop()
     
\ No newline at end of file
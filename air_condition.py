@@ -1,6 +1,10 @@
-import os
-import time
+import logging
+import threading
 from device_config import DeviceConfig
+from ir_codes import IrCodeTable
+from lirc_client import LircClient, LircError
+
+log = logging.getLogger("ac")
 
 IR_REPEATS = 1
 AC_OFF     = 0
@@ -12,15 +16,43 @@ TEMP_AC_LIMIT = 100
 TEMP_AC_MIN = 121
 TEMP_AC_MAX = 125
 
+# Retry delay after a failed IR transmission, doubled for every failure up to max (s)
+IR_RETRY_MIN = 5
+IR_RETRY_MAX = 5*60
+
+# Every temp validate_temp can return, plus AC_ON
+REACHABLE_TEMPS = [AC_OFF, AC_ON, LOW_HEAT] + list(range(TEMP_MIN, TEMP_MAX + 1)) + list(range(TEMP_AC_MIN, TEMP_AC_MAX + 1))
+
+# One client per lircd socket, shared by the devices of a gateway
+lirc_clients = {}
+lirc_clients_lock = threading.Lock()
+
+def get_lirc_client(socket_path):
+    with lirc_clients_lock:
+        if socket_path not in lirc_clients:
+            lirc_clients[socket_path] = LircClient(socket_path)
+        return lirc_clients[socket_path]
+
+# IR codes are sent by a worker thread so callers never wait for the transmission.
+# Only the latest requested temp is kept, intermediate setpoints of a burst are never sent.
 class AirCondition:
     def __init__(self, device_config):
         if device_config.is_simulated:
             self.hardware = False
         else:
             self.hardware = True
+            self.lirc = get_lirc_client(device_config.lirc_socket)
+        self.ir_remote = device_config.ir_remote
+        self.ir_code_by_temp = self.compile_ir_codes(IrCodeTable())
         self.currentTemp = AC_ON
-        self.send_ir_code(AC_ON)
         self.ac_active = False
+        self.sent_temp = None        # Last temp sent to the unit, None if unknown
+        self.last_sent_code = None
+        self.pending_temp = AC_ON
+        self.sending = False
+        self.queue_changed = threading.Condition()
+        self.sender = threading.Thread(target=self.ir_sender, daemon=True)
+        self.sender.start()
 
     # Return a valid version of temp
     def validate_temp(self, temp):
@@ -33,17 +65,16 @@ class AirCondition:
         return temp
 
     # Set the temperature of the AC unit (if changed)
-    # Uses irsend/lirc
+    # Returns at once, the IR code is sent by the worker thread
     def set_temp(self, temp):
         temp = self.validate_temp(temp)
         if temp != self.currentTemp:
-            if self.currentTemp == AC_OFF:
-                self.send_ir_code(AC_ON)
-                print("Switching system back on.")
-                
             self.currentTemp = temp
-
-            self.send_ir_code(temp)
+            self.ac_active = temp > TEMP_AC_LIMIT
+            with self.queue_changed:
+                # Replaces any setpoint not yet sent
+                self.pending_temp = temp
+                self.queue_changed.notify_all()
             
             print("Setting temperature to {} degC".format(temp))
         else:
@@ -54,8 +85,56 @@ class AirCondition:
             return self.currentTemp - TEMP_AC_LIMIT
         return self.currentTemp
 
-    def send_ir_code(self, temp):
-        self.ac_active = False
+    # Wait until all requested setpoints have been sent
+    # return True if idle within timeout
+    def wait_idle(self, timeout=None):
+        with self.queue_changed:
+            return self.queue_changed.wait_for(lambda: self.pending_temp is None and not self.sending, timeout)
+
+    def ir_sender(self):
+        retry_delay = IR_RETRY_MIN
+        while True:
+            with self.queue_changed:
+                self.sending = False
+                self.queue_changed.notify_all()
+                self.queue_changed.wait_for(lambda: self.pending_temp is not None)
+                temp = self.pending_temp
+                self.pending_temp = None
+                self.sending = True
+
+            sent = True
+            if temp != AC_OFF and temp != AC_ON and self.sent_temp in (None, AC_OFF):
+                # The unit must be on before it accepts a temperature
+                sent = self.send_ir_code(AC_ON)
+                if sent:
+                    self.sent_temp = AC_ON
+                    print("Switching system back on.")
+            if sent:
+                sent = self.send_ir_code(temp)
+            if sent:
+                self.sent_temp = temp
+                retry_delay = IR_RETRY_MIN
+                continue
+
+            # Send it again after a delay, unless a new setpoint is requested meanwhile
+            log.warning("Setting temperature {} failed, retrying in {} s".format(temp, retry_delay))
+            with self.queue_changed:
+                if self.pending_temp is None:
+                    self.pending_temp = temp
+                    self.sending = False
+                    self.queue_changed.notify_all()
+                    self.queue_changed.wait_for(lambda: self.pending_temp != temp, retry_delay)
+            retry_delay = min(2 * retry_delay, IR_RETRY_MAX)
+
+    # Map every reachable temp to its IR code, checking that lg_ac.conf has all of them
+    def compile_ir_codes(self, table):
+        ir_code_by_temp = {temp: self.get_ir_code(temp) for temp in REACHABLE_TEMPS}
+        missing = [code for code in ir_code_by_temp.values() if code not in table]
+        if len(missing) > 0:
+            raise Exception("IR codes missing in lg_ac.conf: {}".format(", ".join(missing)))
+        return ir_code_by_temp
+
+    def get_ir_code(self, temp):
         if temp == AC_OFF:
             ircode = "AC_OFF"
         elif temp == AC_ON:
@@ -64,14 +143,24 @@ class AirCondition:
             ircode = "LH_HIGH_10"
         elif temp > TEMP_AC_LIMIT:
             ircode = "AC_HIGH_{}".format(temp-TEMP_AC_LIMIT)
-            self.ac_active = True
         else:
             ircode = "HEAT_HIGH_{}".format(temp)
+        return ircode
+
+    # return True if lircd has transmitted the code
+    def send_ir_code(self, temp):
+        ircode = self.ir_code_by_temp[temp]
 
         if self.hardware:
+            # lircd answers when the code has been transmitted
             for i in range(IR_REPEATS):
-                os.system("irsend SEND_ONCE LG_AC {}".format(ircode))
-                time.sleep(1)
+                try:
+                    self.lirc.send_once(self.ir_remote, ircode)
+                except LircError as e:
+                    log.error("Could not send IR code {}: {}".format(ircode, e))
+                    return False
+        self.last_sent_code = ircode
+        return True
     
 if __name__ == '__main__':
     device_config = DeviceConfig()
@@ -83,3 +172,5 @@ if __name__ == '__main__':
     ac.set_temp(10)
     ac.set_temp(0)
     ac.set_temp(1)
+    ac.wait_idle()
+    print("Last sent IR code: {}".format(ac.last_sent_code))
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+log = logging.getLogger("runtime")
+
+# How often the fallback date and the weather cache are checked (s)
+FALLBACK_CHECK_INTERVAL = 60
+WEATHER_CHECK_INTERVAL  = 60
+
+# Runs an IotDevice as independent asyncio tasks instead of one sequential loop.
+# Blocking sensor, SDK and HTTP calls run in the default executor, so a slow
+# network call only delays its own task. A temperature alert triggers the
+# telemetry task at once.
+class AsyncRuntime:
+    def __init__(self, device):
+        self.device = device
+        self.temp_m = None
+
+    def run(self):
+        try:
+            asyncio.run(self.main())
+        except KeyboardInterrupt:
+            print ( "IoTHubClient sample stopped by Ctrl-C" )
+
+    # Run a blocking call in the executor
+    async def call(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def main(self):
+        device = self.device
+        print ( "Starting IoT Device with ID '{}' (asyncio runtime)".format(device.device_config.deviceid) )
+        self.send_now = asyncio.Event()
+        device.hub.start()
+        await self.call(device.hub.kick)
+        device.telemetry_uploader.start()
+
+        # First sample before the first telemetry, and a weather fetch started if the cache is old
+        temp_c, self.temp_m = await self.call(device.temperature.get)
+        await self.call(device.weather.get)
+
+        await asyncio.gather(
+            self.periodic("sampling", device.temperature.temp_sampling, self.sample),
+            self.periodic("hub", device.temperature.temp_sampling, lambda: self.call(device.hub.kick)),
+            self.periodic("fallback", FALLBACK_CHECK_INTERVAL, lambda: self.call(device.check_fallback)),
+            self.periodic("weather", WEATHER_CHECK_INTERVAL, self.refresh_weather),
+            self.periodic("stats", FALLBACK_CHECK_INTERVAL, lambda: self.call(device.log_hub_stats)),
+            self.telemetry())
+
+    # Run task() every interval seconds, logging but surviving exceptions
+    async def periodic(self, name, interval, task):
+        while True:
+            try:
+                await task()
+            except Exception:
+                log.exception("Exception in {} task @ {}".format(name, datetime.now()))
+            await asyncio.sleep(interval)
+
+    async def sample(self):
+        self.device.heartbeat.beat("sample")
+        temp_c, self.temp_m = await self.call(self.device.temperature.get)
+        alert = self.device.get_temp_alert(self.temp_m)
+        if alert != self.device.reported_temp_alert:
+            # Send telemetry now, the telemetry task reports the new alert state
+            self.send_now.set()
+        elif not self.send_now.is_set():
+            change = self.device.get_report_change(self.temp_m)
+            if change is not None:
+                print("Reporting telemetry: {}".format(change))
+                self.send_now.set()
+
+    # Start a weather fetch in the background when it is due, also between telemetry
+    async def refresh_weather(self):
+        await self.call(self.device.weather.get)
+
+    # Queue telemetry every telemetryInterval (heartbeat), or at once on an alert change or reported change
+    async def telemetry(self):
+        device = self.device
+        while True:
+            self.send_now.clear()
+            try:
+                current_alert = device.reported_temp_alert
+                device.reported_temp_alert = device.get_temp_alert(self.temp_m)
+                # Weather.get does not block, in forecast mode it interpolates for the time of the telemetry
+                telemetry = device.create_telemetry(self.temp_m, device.weather.get(time.time()))
+                await self.call(device.queue_telemetry, telemetry)
+                if current_alert != device.reported_temp_alert:
+                    await self.call(device.update_reported_state)
+            except Exception:
+                log.exception("Exception in telemetry task @ {}".format(datetime.now()))
+
+            try:
+                await asyncio.wait_for(self.send_now.wait(), device.get_telemetry_interval())
+            except asyncio.TimeoutError:
+                pass
@@ -1,7 +1,15 @@
 from device_config import DeviceConfig
 import json
+import logging
+import threading
+import time
+from collections import deque
 import iothub_client
 from iothub_client import IoTHubClient, IoTHubMessage, IoTHubClientError, IoTHubTransportProvider, IoTHubClientResult, IoTHubError
+from iothub_client import IoTHubClientConfirmationResult
+from telemetry_codec import TelemetryEncoder
+
+log = logging.getLogger("azure")
 
 # choose HTTP, AMQP, AMQP_WS or MQTT as transport protocol
 PROTOCOL = IoTHubTransportProvider.MQTT
@@ -9,6 +17,15 @@ PROTOCOL = IoTHubTransportProvider.MQTT
 TWIN_CONTEXT = 0
 SEND_REPORTED_STATE_CONTEXT = 0
 
+# Max telemetry messages sent but not yet confirmed by the hub
+MAX_IN_FLIGHT = 20
+# Seconds to wait for a free slot in the window or for a confirmation
+CONFIRMATION_TIMEOUT = 60
+# Max telemetry records combined in one message when sending a backlog
+MAX_BATCH_RECORDS = 20
+# Number of delivery latencies kept for the statistics
+LATENCY_SAMPLES = 1000
+
 azure_singelton = None
 
 # Local callbacks from iot_client
@@ -36,10 +53,18 @@ class Azure:
             raise Exception("Azure connection string does not match configured device id")
             
         self.application = application
+        # Wire format of telemetry: json (default), cbor or msgpack, optionally gzip for batches
+        self.encoder = TelemetryEncoder(self.config.get('format', 'json'), self.config.get('gzip_batches', False))
+        # Send a backlog as arrays of records instead of one message per record. Changes the message
+        # schema for consumers and routes, so it is off by default and marked with the property batch=true.
+        self.batch_messages = self.config.get('batch_messages', False)
+        # Telemetry sent but not confirmed, keyed by the user context given to send_event_async
+        self.in_flight = {}
+        self.in_flight_changed = threading.Condition()
+        self.next_context = 1
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.stats = {"sent": 0, "confirmed": 0, "failed": 0, "timeout": 0, "window_full": 0}
         self.hubClient   = IoTHubClient(self.config['connection_string'], PROTOCOL)
-        if self.hubClient.protocol == IoTHubTransportProvider.MQTT or self.hubClient.protocol == IoTHubTransportProvider.MQTT_WS:
-            self.hubClient.set_device_twin_callback(
-                device_twin_callback, TWIN_CONTEXT)
 
     # Report current state to cloud
     def update_reported_state(self, reported):
@@ -52,19 +77,119 @@ class Azure:
                                                SEND_REPORTED_STATE_CONTEXT)
             return True
         except IoTHubError as iothub_error:
-            print ( "AZURE: Unexpected error from IoTHub when reporting state: %s" % iothub_error )
+            log.error ( "AZURE: Unexpected error from IoTHub when reporting state: %s" % iothub_error )
         return False
         
     # Post telemetry to cloud
+    # return True when the hub has confirmed the message
     def post_telemetry(self, telemetry):
         try:
-            message = IoTHubMessage(json.dumps(telemetry))
-            self.hubClient.send_event_async(message, send_confirmation_callback, None)
-            return True
+            context = self.send_message(telemetry, {})
+            if context is not None:
+                return self.wait_for_confirmation([context])
         except IoTHubError as iothub_error:
-            print ( "AZURE: Unexpected error from IoTHub when posting telemetry: %s" % iothub_error )
+            log.error ( "AZURE: Unexpected error from IoTHub when posting telemetry: %s" % iothub_error )
         return False
-    
+
+    # Post several telemetry records, one message per record, or with batch_messages up to
+    # MAX_BATCH_RECORDS in each message as an array. All messages are in flight at the same time.
+    # return True when the hub has confirmed all messages
+    def post_telemetry_batch(self, records):
+        if self.batch_messages:
+            batches = [records[i:i + MAX_BATCH_RECORDS] for i in range(0, len(records), MAX_BATCH_RECORDS)]
+            return self.send_messages([(batch, {"batch": "true", "batchSize": str(len(batch))}, True) for batch in batches])
+        # At most a full window of single record messages at a time
+        for i in range(0, len(records), MAX_IN_FLIGHT):
+            if not self.send_messages([(record, {}, False) for record in records[i:i + MAX_IN_FLIGHT]]):
+                return False
+        return True
+
+    # Send messages [(telemetry, properties, batch)] and wait for all confirmations
+    # return True when the hub has confirmed all messages
+    def send_messages(self, messages):
+        contexts = []
+        try:
+            for telemetry, properties, batch in messages:
+                context = self.send_message(telemetry, properties, batch)
+                if context is None:
+                    break
+                contexts.append(context)
+        except IoTHubError as iothub_error:
+            log.error ( "AZURE: Unexpected error from IoTHub when posting telemetry: %s" % iothub_error )
+        # Wait also after a failure, so the window is released
+        delivered = self.wait_for_confirmation(contexts)
+        return delivered and len(contexts) == len(messages)
+
+    # Send a message when there is room in the in flight window
+    # return context to wait for, or None if the window stayed full
+    def send_message(self, telemetry, properties, batch=False):
+        payload, content_type, content_encoding = self.encoder.encode(telemetry, batch)
+        if isinstance(payload, bytes):
+            message = IoTHubMessage(bytearray(payload))
+        else:
+            message = IoTHubMessage(payload)
+        # System properties used by IoT Hub routing
+        message.set_content_type_system_property(content_type)
+        if content_encoding is not None:
+            message.set_content_encoding_system_property(content_encoding)
+        message_properties = message.properties()
+        for key, value in properties.items():
+            message_properties.add(key, value)
+
+        with self.in_flight_changed:
+            if not self.in_flight_changed.wait_for(lambda: len(self.in_flight) < MAX_IN_FLIGHT, CONFIRMATION_TIMEOUT):
+                self.stats["window_full"] += 1
+                print("AZURE: {} messages waiting for confirmation. Telemetry kept for later.".format(len(self.in_flight)))
+                return None
+            context = self.next_context
+            self.next_context += 1
+            self.in_flight[context] = {"sent_at": time.monotonic(), "result": None}
+            self.stats["sent"] += 1
+
+        try:
+            self.hubClient.send_event_async(message, send_confirmation_callback, context)
+        except:
+            with self.in_flight_changed:
+                del self.in_flight[context]
+                self.in_flight_changed.notify_all()
+            raise
+        return context
+
+    # Wait until the hub has confirmed the messages and release them from the window
+    # return True if all were delivered
+    def wait_for_confirmation(self, contexts):
+        with self.in_flight_changed:
+            self.in_flight_changed.wait_for(
+                lambda: all(self.in_flight[context]["result"] is not None for context in contexts),
+                CONFIRMATION_TIMEOUT)
+            delivered = True
+            for context in contexts:
+                result = self.in_flight.pop(context)["result"]
+                if result is None:
+                    self.stats["timeout"] += 1
+                    delivered = False
+                elif result != IoTHubClientConfirmationResult.OK:
+                    delivered = False
+            self.in_flight_changed.notify_all()
+        return delivered
+
+    # Message counters and delivery latency percentiles in seconds
+    def get_stats(self):
+        with self.in_flight_changed:
+            stats = dict(self.stats)
+            stats["in_flight"] = len(self.in_flight)
+            latencies = sorted(self.latencies)
+        for p in [50, 90, 99]:
+            if len(latencies) > 0:
+                stats["latency_p{}".format(p)] = round(latencies[min(len(latencies) - 1, len(latencies) * p // 100)], 3)
+        return stats
+
+    # Start receiving desired state. Called when the application is ready to handle it.
+    def start(self):
+        if self.hubClient.protocol == IoTHubTransportProvider.MQTT or self.hubClient.protocol == IoTHubTransportProvider.MQTT_WS:
+            self.hubClient.set_device_twin_callback(
+                device_twin_callback, TWIN_CONTEXT)
+
     # Keep cloud connection open (not needed for azure)
     def kick(self):
         pass
@@ -80,7 +205,17 @@ class Azure:
         self.application.device_twin_update(desired_state)
 
     def send_confirmation_callback(self, message, result, user_context):
-        print ( "AZURE: IoT Hub responded to message with status: %s" % (result) )
+        with self.in_flight_changed:
+            entry = self.in_flight.get(user_context)
+            if entry is not None:
+                entry["result"] = result
+                self.latencies.append(time.monotonic() - entry["sent_at"])
+            if result == IoTHubClientConfirmationResult.OK:
+                self.stats["confirmed"] += 1
+            else:
+                self.stats["failed"] += 1
+                print ( "AZURE: IoT Hub responded to message with status: %s" % (result) )
+            self.in_flight_changed.notify_all()
 
     def send_reported_state_callback(self, status_code, user_context):
         print ( "AZURE: Confirmation for reported state called with status_code: %d" % status_code )
@@ -0,0 +1,53 @@
+import importlib
+import json
+from urllib.parse import urlparse
+
+# Cloud backends by the name used as "cloud" in device_config.json:
+# name -> (module, class, function returning the (host, port) the backend connects to,
+#          class of a connection several backend instances can share or None).
+# The module, and the SDK it imports, is only loaded when its backend is created.
+CLOUD_BACKENDS = {}
+
+def register_backend(name, module, class_name, endpoint, connection_class=None):
+    CLOUD_BACKENDS[name] = (module, class_name, endpoint, connection_class)
+
+def firebase_endpoint():
+    with open('firebase.json') as f:
+        config = json.load(f)
+    return urlparse(config['db_config']['databaseURL']).hostname, 443
+
+def azure_endpoint():
+    with open('azure.json') as f:
+        config = json.load(f)
+    fields = dict(part.split('=', 1) for part in config['connection_string'].split(';') if '=' in part)
+    # MQTT over TLS
+    return fields['HostName'], 8883
+
+register_backend("azure",    "azure",    "Azure",    azure_endpoint)
+register_backend("firebase", "firebase", "Firebase", firebase_endpoint, "FirebaseConnection")
+
+def get_backend(name):
+    if name not in CLOUD_BACKENDS:
+        raise Exception("Supported cloud services are {}. Update 'device_config.json'.".format(
+            " and ".join("'{}'".format(name) for name in sorted(CLOUD_BACKENDS))))
+    return CLOUD_BACKENDS[name]
+
+# (host, port) the named backend connects to
+def get_endpoint(name):
+    return get_backend(name)[2]()
+
+# Import the module of the named backend and create it, on a shared connection if given
+def create_backend(name, application, device_config, connection=None):
+    module, class_name, endpoint, connection_class = get_backend(name)
+    backend_class = getattr(importlib.import_module(module), class_name)
+    if connection is not None:
+        return backend_class(application, device_config, connection=connection)
+    return backend_class(application, device_config)
+
+# Create a connection to be shared by several instances of the named backend
+# Raises an exception if the backend can not share a connection
+def create_connection(name):
+    module, class_name, endpoint, connection_class = get_backend(name)
+    if connection_class is None:
+        raise Exception("Cloud service '{}' can not be used by a gateway with several devices".format(name))
+    return getattr(importlib.import_module(module), connection_class)()
@@ -1,6 +1,10 @@
+import copy
 import json
 import re
 
+# Keys a logical device of a gateway can set, the rest is shared by all devices
+DEVICE_KEYS = ["deviceid", "is_simulated", "temp_sensor", "ir_remote", "lirc_socket"]
+
 class DeviceConfig:
     def __init__(self):
         with open('device_config.json') as f:
@@ -12,6 +16,24 @@ class DeviceConfig:
         self.cloud         = config["cloud"]
         self.temp_sampling = config["temp_sampling"] # in sec
         self.temp_average  = config["temp_average"]  # in no of intervals, e.g. TIME = temp_average * temp_sampling seconds
+        self.temp_sampler  = config.get("temp_sampler", False) # sample sensor in a background thread
+        self.temp_resolution = config.get("temp_resolution", None) # DS18B20 resolution 9-12 bits, None keeps sensor setting
+        self.telemetry_queue_size = config.get("telemetry_queue_size", 10000) # max telemetry records kept while offline
+        self.async_runtime = config.get("async_runtime", False) # run sampling, hub, weather and telemetry as asyncio tasks
+        self.temp_percentiles = config.get("temp_percentiles", [10, 50, 90]) # percentiles in telemetry temp summary
+        self.sample_store_days = config.get("sample_store_days", 0) # days of raw samples kept on disk (about 0.8 MB per day and sensor at 5 s sampling), 0 disables
+        self.log_max_bytes = config.get("log_max_bytes", 1024*1024) # log file is rotated at this size
+        self.log_segments  = config.get("log_segments", 3) # number of rotated log files kept
+        self.heartbeat_timeout = config.get("heartbeat_timeout", 90) # IotDevice is restarted after this many s without heartbeat
+        # max s to wait for the cloud to be reachable at start. IotDevice sends heartbeats while waiting,
+        # so it may be longer than heartbeat_timeout without the supervisor restarting it.
+        self.network_deadline = config.get("network_deadline", 120)
+        self.temp_sensor   = config.get("temp_sensor", None) # id of the DS18B20 to use, None uses all found
+        self.ir_remote     = config.get("ir_remote", "LG_AC") # lircd remote name of the AC
+        self.lirc_socket   = config.get("lirc_socket", "/var/run/lirc/lircd") # lircd socket sending to the AC
+        self.devices       = config.get("devices", None) # gateway mode: list of logical devices, each with DEVICE_KEYS
+        self.state_file    = 'desired_state.json'
+        self.sample_store_file = 'samples.ring'
 
         s = ""
         if self.is_simulated:
@@ -23,6 +45,22 @@ class DeviceConfig:
             l = "stdout"
 
         print("Starting {}device {} with logging to {}".format(s, self.deviceid, l))
+
+    # Configs of the logical devices in gateway mode, each with its own state and sample files
+    def device_configs(self):
+        configs = []
+        for device in self.devices:
+            unknown = set(device) - set(DEVICE_KEYS)
+            if len(unknown) > 0:
+                raise Exception("Gateway devices can only set {}, not {}".format(", ".join(DEVICE_KEYS), ", ".join(unknown)))
+            config = copy.copy(self)
+            config.devices = None
+            for key, value in device.items():
+                setattr(config, key, value)
+            config.state_file = "desired_state_{}.json".format(config.deviceid)
+            config.sample_store_file = "samples_{}.ring".format(config.deviceid)
+            configs.append(config)
+        return configs
             
 if __name__ == '__main__':
     device = DeviceConfig()
@@ -33,4 +71,19 @@ if __name__ == '__main__':
     print("Used cloud service = {}".format(device.cloud))   
     print("Temp sampling      = {} s".format(device.temp_sampling))
     print("Temp average       = {} intervals".format(device.temp_average))
-    print("Temp average time  = {} s".format(device.temp_average * device.temp_sampling))
\ No newline at end of file
+    print("Temp average time  = {} s".format(device.temp_average * device.temp_sampling))
+    print("Temp sampler       = {}".format(device.temp_sampler))
+    print("Temp resolution    = {} bits".format(device.temp_resolution))
+    print("Telemetry queue    = {} records".format(device.telemetry_queue_size))
+    print("Async runtime      = {}".format(device.async_runtime))
+    print("Temp percentiles   = {}".format(device.temp_percentiles))
+    print("Sample store       = {} days".format(device.sample_store_days))
+    print("Log rotation       = {} bytes, {} segments".format(device.log_max_bytes, device.log_segments))
+    print("Heartbeat timeout  = {} s".format(device.heartbeat_timeout))
+    print("Network deadline   = {} s".format(device.network_deadline))
+    print("Temp sensor        = {}".format(device.temp_sensor))
+    print("IR remote          = {} via {}".format(device.ir_remote, device.lirc_socket))
+    if device.devices is not None:
+        for config in device.device_configs():
+            print("Gateway device     = {}, sensor {}, IR remote {} via {}".format(
+                config.deviceid, config.temp_sensor, config.ir_remote, config.lirc_socket))
\ No newline at end of file
@@ -0,0 +1,187 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+# Log file is rotated when it exceeds LOG_MAX_BYTES, keeping LOG_SEGMENTS old files (log.1 is the newest)
+LOG_MAX_BYTES = 1024*1024
+LOG_SEGMENTS  = 3
+
+# Log lines are written to the SD card in batches, at the latest after LOG_FLUSH_INTERVAL seconds
+# or LOG_FLUSH_RECORDS records. Records of level WARNING and above are written at once,
+# so the reason for a restart or reboot is on the card before it happens.
+LOG_FLUSH_INTERVAL = 30
+LOG_FLUSH_RECORDS  = 100
+LOG_BUFFER_SIZE    = 64*1024
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# LogWriter started by setup_logging
+log_writer = None
+
+# Structured fields of a log record: log.warning("Upload failed", extra=fields(queued=12))
+def fields(**kwargs):
+    return {"fields": kwargs}
+
+# Appends the record's fields as key=value after the message
+class StructuredFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__(LOG_FORMAT)
+
+    def format(self, record):
+        line = super().format(record)
+        record_fields = getattr(record, "fields", None)
+        if record_fields:
+            line += " " + " ".join("{}={}".format(key, value) for key, value in record_fields.items())
+        return line
+
+# Log file with batched writes and size based rotation.
+# Keeps the size itself, so no seek or stat is needed per record.
+class BufferedRotatingFileHandler(logging.Handler):
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, segments=LOG_SEGMENTS,
+                 flush_interval=LOG_FLUSH_INTERVAL, flush_records=LOG_FLUSH_RECORDS):
+        super().__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segments = segments
+        self.flush_interval = flush_interval
+        self.flush_records = flush_records
+        self.pending = 0
+        self.flushed_at = time.monotonic()
+        self.open()
+
+    def open(self):
+        self.stream = open(self.path, "a", buffering=LOG_BUFFER_SIZE, encoding="utf-8", errors="replace")
+        self.size = self.stream.tell()
+
+    def emit(self, record):
+        try:
+            line = self.format(record) + "\n"
+            length = len(line.encode("utf-8", "replace"))
+            if self.size > 0 and self.size + length > self.max_bytes:
+                self.rotate()
+            self.stream.write(line)
+            self.size += length
+            self.pending += 1
+            if (record.levelno >= logging.WARNING or self.pending >= self.flush_records or
+                    time.monotonic() - self.flushed_at > self.flush_interval):
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    # Report a failed write, e.g. a full SD card, on the real stderr. The default handleError
+    # writes to sys.stderr, a LogStream that would send the report back to this handler forever.
+    def handleError(self, record):
+        try:
+            sys.__stderr__.write("Log record not written: {}\n".format(sys.exc_info()[1]))
+        except Exception:
+            pass
+
+    def flush(self):
+        if self.pending > 0:
+            self.stream.flush()
+            self.pending = 0
+        self.flushed_at = time.monotonic()
+
+    # log -> log.1 -> log.2 ..., the oldest segment is deleted
+    def rotate(self):
+        self.stream.close()
+        for i in range(self.segments, 0, -1):
+            source = self.path if i == 1 else "{}.{}".format(self.path, i - 1)
+            if os.path.exists(source):
+                os.replace(source, "{}.{}".format(self.path, i))
+        if self.segments == 0:
+            os.remove(self.path)
+        self.pending = 0
+        self.open()
+
+    def close(self):
+        self.flush()
+        self.stream.close()
+        super().close()
+
+# Single thread writing queued log records, so logging never waits for the SD card
+class LogWriter:
+    def __init__(self, log_queue, handler):
+        self.queue = log_queue
+        self.handler = handler
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=self.handler.flush_interval)
+            except queue.Empty:
+                # Quiet for a while, write what is buffered
+                self.handler.flush()
+                continue
+            if record is None:
+                break
+            self.handler.handle(record)
+        self.handler.close()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join(5)
+
+# Lines printed to sys.stdout/sys.stderr become log records, one per line
+class LogStream:
+    def __init__(self, logger, level):
+        self.logger = logger
+        self.level = level
+        self.local = threading.local()
+
+    def write(self, text):
+        if log_writer is not None and threading.current_thread() is log_writer.thread:
+            # Output of the log writer itself can not be logged
+            try:
+                return sys.__stderr__.write(text)
+            except Exception:
+                return len(text)
+        buffered = getattr(self.local, "buffer", "") + text
+        while "\n" in buffered:
+            line, buffered = buffered.split("\n", 1)
+            if line.strip():
+                self.logger.log(self.level, line.rstrip())
+        self.local.buffer = buffered
+        return len(text)
+
+    def flush(self):
+        # Writing to disk is up to the log writer
+        pass
+
+    def isatty(self):
+        return False
+
+# Send logging and everything printed to path through a queue and a writer thread.
+# path None logs to the console.
+def setup_logging(path, max_bytes=LOG_MAX_BYTES, segments=LOG_SEGMENTS, level=logging.INFO):
+    root = logging.getLogger()
+    root.setLevel(level)
+    if path is None:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(StructuredFormatter())
+        root.addHandler(handler)
+        return
+
+    handler = BufferedRotatingFileHandler(path, max_bytes, segments)
+    handler.setFormatter(StructuredFormatter())
+    log_queue = queue.Queue()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    global log_writer
+    log_writer = LogWriter(log_queue, handler)
+    atexit.register(stop_logging)
+
+    sys.stdout = LogStream(logging.getLogger("stdout"), logging.INFO)
+    sys.stderr = LogStream(logging.getLogger("stderr"), logging.ERROR)
+
+# Write the queued and buffered log records and stop the writer.
+# Called at exit, and by signal handlers since a process killed by a signal skips atexit.
+def stop_logging():
+    if log_writer is not None and log_writer.thread.is_alive():
+        log_writer.stop()
@@ -1,42 +1,75 @@
 from device_config import DeviceConfig
+from firebase_auth import FirebaseCredentials, TOKEN_CACHE_FILE
+from firebase_session import FirebaseSession
+from firebase_stream import FirebaseStream
 import pyrebase
 import json
+import logging
+import threading
 import time
 from datetime import datetime
 import json
 
-class Firebase:
-    def __init__(self, application, device_config):
-        self.application = application
+log = logging.getLogger("firebase")
 
+# Pyrebase app, keep-alive session, database handle and login.
+# Shared by all devices of a gateway.
+class FirebaseConnection:
+    def __init__(self):
         with open('firebase.json') as f:
             self.config = json.load(f)
 
-        self.deviceid = device_config.deviceid
         self.hub = pyrebase.initialize_app(self.config['db_config'])
+        # One keep-alive session and database handle for all calls
+        self.session = FirebaseSession()
+        self.hub.requests = self.session.session
+        self.db = self.hub.database()
+        self.db_lock = threading.Lock()
+        self.credentials = FirebaseCredentials(self.hub, self.config, session=self.session, cache_file=TOKEN_CACHE_FILE)
+
+class Firebase:
+    def __init__(self, application, device_config, connection=None):
+        self.application = application
+        if connection is None:
+            connection = FirebaseConnection()
+
+        self.config = connection.config
+        self.deviceid = device_config.deviceid
+        self.hub = connection.hub
+        self.session = connection.session
+        self.db = connection.db
+        self.db_lock = connection.db_lock
+        self.credentials = connection.credentials
+        self.twin_lock = threading.Lock()
         self.FIREBASE_DEVICE_TWIN_POLL_TIME = 1*60 # 1 min. Tradeoff between resource util and response time when changing set temperature
-        self.FIREBASE_TOKEN_REFRESH_TIME   = 40*60 # 40 min. Should be less than an hour 
-        self.token_renewal_time    = -10000
         self.device_twin_poll_time = -10000
         self.desired_state = None
         self.login()
+        # Get desired state pushed from the database instead of polling, polling is used while the stream is down
+        self.twin_stream = None
+        if self.config.get('twin_stream', False):
+            self.twin_stream = FirebaseStream(self, lambda: self.hub_root + '/device_twin/desired', self.handle_desired_state)
+
+    # Start receiving desired state. Called when the application is ready to handle it,
+    # an update arriving before it has loaded its saved state would be overwritten.
+    def start(self):
+        if self.twin_stream is not None:
+            self.twin_stream.start()
 
     # Keep cloud connection open
     def kick(self):
         elapsed = time.monotonic() - self.device_twin_poll_time
         #print("FIREBASE: kick " + str(elapsed))
         if elapsed > self.FIREBASE_DEVICE_TWIN_POLL_TIME:
-            self.read_state()
-
-        elapsed = time.monotonic() - self.token_renewal_time
-        if elapsed > self.FIREBASE_TOKEN_REFRESH_TIME:
-            self.refresh_token()
+            if self.twin_stream is not None and self.twin_stream.connected:
+                self.device_twin_poll_time = time.monotonic()
+            else:
+                self.read_state()
 
     # Post telemetry to cloud
     def post_telemetry(self, telemetry):
         #print("FIREBASE: post_telemetry")
-        self.read_state()
-        user = self.user
+        user = self.get_user()
         
         if user is not None:
             try:
@@ -44,96 +77,142 @@ class Firebase:
                     if key[0] == "$":
                         telemetry[key[1:]] = telemetry.pop(key)
                 
-                # Get a reference to the database service
-                db = self.hub.database()
-
                 # Pass the user's idToken to the push method
-                results = db.child(self.hub_root, 'telemetry').push(telemetry, user['idToken'])
+                results = self.db_call("push", lambda db, token: db.child(self.hub_root, 'telemetry').push(telemetry, token))
                 print("FIREBASE: Telemetry stored as hub id: {} @ {}".format(results["name"], datetime.now()))
                 return True
             except Exception as e:
-                print("FIREBASE: Post operation failed.")
-                print(e)
+                log.error("FIREBASE: Post operation failed: {}".format(e))
         else:
-            print("FIREBASE: Not logged in. No telemetry sent. @ {}".format(datetime.now()))
+            log.warning("FIREBASE: Not logged in. No telemetry sent. @ {}".format(datetime.now()))
+        return False
+
+    # Post several telemetry records in one multi-path update
+    def post_telemetry_batch(self, records):
+        user = self.get_user()
+
+        if user is not None:
+            try:
+                for telemetry in records:
+                    for key,obj in telemetry.copy().items():
+                        if key[0] == "$":
+                            telemetry[key[1:]] = telemetry.pop(key)
+
+                # Push ids are generated in order so the records keep their order in the database
+                self.db_call("update", lambda db, token: db.child(self.hub_root, 'telemetry').update(
+                    {db.generate_key(): telemetry for telemetry in records}, token))
+                print("FIREBASE: {} telemetry records stored @ {}".format(len(records), datetime.now()))
+                return True
+            except Exception as e:
+                log.error("FIREBASE: Batch post operation failed: {}".format(e))
+        else:
+            log.warning("FIREBASE: Not logged in. No telemetry sent. @ {}".format(datetime.now()))
+        return False
+
+    # Post telemetry of several devices of the logged in user in one multi-path update
+    # records: [(deviceid, telemetry)]
+    def post_device_telemetry_batch(self, records):
+        user = self.get_user()
+
+        if user is not None:
+            try:
+                for deviceid, telemetry in records:
+                    for key,obj in telemetry.copy().items():
+                        if key[0] == "$":
+                            telemetry[key[1:]] = telemetry.pop(key)
+
+                self.db_call("update", lambda db, token: db.child('users', user['localId']).update(
+                    {"{}/telemetry/{}".format(deviceid, db.generate_key()): telemetry for deviceid, telemetry in records}, token))
+                print("FIREBASE: {} telemetry records of {} devices stored @ {}".format(
+                    len(records), len(set(deviceid for deviceid, telemetry in records)), datetime.now()))
+                return True
+            except Exception as e:
+                log.error("FIREBASE: Device batch post operation failed: {}".format(e))
+        else:
+            log.warning("FIREBASE: Not logged in. No telemetry sent. @ {}".format(datetime.now()))
         return False
 
     # Read desired state from cloud
     def read_state(self, bank='desired'):
         #print("FIREBASE: read_state")
-        self.refresh_token()
         self.device_twin_poll_time = time.monotonic()    
 
-        user = self.user
+        user = self.get_user()
         new_state = None
         
         if user is not None:
             try:
-                # Get a reference to the database service
-                db = self.hub.database()
-
-                new_state = dict(db.child(self.hub_root,'device_twin', bank).get(token=user['idToken']).val())
-                #print(new_state)
+                if self.is_state_changed(bank):
+                    new_state = dict(self.db_call("get", lambda db, token: db.child(self.hub_root,'device_twin', bank).get(token=token)).val())
+                    #print(new_state)
             except Exception as e:
-                print("FIREBASE: read_desired_state operation failed.")
-                print(e)
+                log.error("FIREBASE: read_desired_state operation failed: {}".format(e))
                 new_state = None
         else:
             print("Not logged in. Device twin not fetched at {}".format(datetime.now()))
 
         if new_state != None:
-            if self.desired_state == None or new_state['updateTime'] != self.desired_state['updateTime']:
+            self.handle_desired_state(new_state)
+
+    # Read only updateTime of the device twin (a few bytes) and compare it with the last fetched state.
+    # The full twin is only downloaded when this returns True.
+    def is_state_changed(self, bank):
+        if self.desired_state == None:
+            return True
+        with self.twin_lock:
+            known_update_time = self.desired_state.get('updateTime')
+        update_time = self.db_call("get", lambda db, token: db.child(self.hub_root, 'device_twin', bank, 'updateTime').get(token=token)).val()
+        return update_time is None or update_time != known_update_time
+
+    # Forward the device twin to the application if it has been updated
+    def handle_desired_state(self, new_state):
+        with self.twin_lock:
+            if self.desired_state == None or new_state.get('updateTime') != self.desired_state.get('updateTime'):
                 self.desired_state = new_state
                 if self.application:
                     self.application.device_twin_update(new_state)
-        
+
     # Report current state to cloud
     def update_reported_state(self, device_twin, bank='reported'):
         print("FIREBASE: update_reported_state")
-        self.refresh_token()
-        user = self.user
+        user = self.get_user()
         
         if user is not None:
             try:
-                # Get a reference to the database service
-                db = self.hub.database()
-
-                db.child(self.hub_root, 'device_twin', bank).set(device_twin, user['idToken'])
+                self.db_call("set", lambda db, token: db.child(self.hub_root, 'device_twin', bank).set(device_twin, token))
                 return True
             except Exception as e:
-                print("FIREBASE: store_twin operation failed.")
-                print(e)
+                log.error("FIREBASE: store_twin operation failed: {}".format(e))
         else:
-            print("FIREBASE: Not logged in. No device twin stored. @ {}".format(datetime.now()))
+            log.warning("FIREBASE: Not logged in. No device twin stored. @ {}".format(datetime.now()))
 
         return False
 
     # Login to Firebase
     def login(self):
-        # Get a reference to the auth service
-        print("FIREBASE login")
-        try:
-            user = self.hub.auth().sign_in_with_email_and_password(self.config['user'], self.config['password'])
-            self.user = user
+        self.get_user()
+
+    # Logged in user with a valid token, or None
+    def get_user(self):
+        user = self.credentials.get_user()
+        if user is not None:
             self.hub_root = 'users' + '/' + user['localId'] + '/' + self.deviceid
-        except Exception as e:
-            self.user = None
-            print("FIREBASE: Login failed.")
-            print(e)
-
-    # Refresh Firebase token to keep connection alive
-    def refresh_token(self):
-        #print("FIREBASE: refresh_token")
-        self.token_renewal_time = time.monotonic()    
-        try:
-            refresh = self.hub.auth().refresh(self.user['refreshToken'])
-            self.user['refreshToken'] = refresh['refreshToken']
-            self.user['idToken'] = refresh['idToken']
-        except Exception as e:
-            print("FIREBASE: Refresh token failed.")
-            print(e)
-            self.login()
-            
+        return user
+
+    # Run operation(db, token) on the shared database handle with the timeout of the named operation
+    def db_call(self, name, operation):
+        def run(token):
+            with self.db_lock, self.session.operation(name):
+                # The handle keeps the child path between calls, start from the root
+                self.db.path = ""
+                return operation(self.db, token)
+        return self.credentials.call(run)
+
+    # Login, token refresh and connection reuse counters
+    def get_stats(self):
+        stats = self.credentials.get_stats()
+        stats["connections"] = self.session.get_stats()
+        return stats
 
 if __name__ == '__main__':
     device_config = DeviceConfig()
@@ -152,9 +231,11 @@ if __name__ == '__main__':
     hub.read_state()   # Updates hub.desired_state
     print(hub.desired_state)
     print(hub.desired_state == test)
+    print(hub.get_stats())
     
     hub.update_reported_state(test)
     hub.read_state(bank='reported')
     print(hub.desired_state)
     print(hub.desired_state == test)
+    print(hub.get_stats())
     
\ No newline at end of file
@@ -0,0 +1,251 @@
+import base64
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+log = logging.getLogger("auth")
+
+# Refresh the idToken when less than this many seconds remain before it expires
+TOKEN_EXPIRY_MARGIN = 5*60
+# Firebase auth REST endpoints, used when a shared HTTP session is given
+SIGN_IN_URL = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/verifyPassword?key={}"
+REFRESH_URL = "https://securetoken.googleapis.com/v1/token?key={}"
+
+# Assumed lifetime if the expiry can not be decoded from the token (Firebase uses 1 hour)
+TOKEN_DEFAULT_LIFETIME = 40*60
+
+# Login shared by the processes of the device (IotDevice and the rebooter), locked by <file>.lock.
+# IotDevice runs as root and the rebooter as the owner of the directory, so the cache and
+# the lock are owned by the owner of the directory they are in, whoever creates them.
+TOKEN_CACHE_FILE = 'firebase_token.json'
+
+# Return the expiry time (epoch seconds) of a Firebase idToken (JWT), or None if not decodable
+def token_expiry(id_token):
+    try:
+        payload = id_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except Exception:
+        return None
+
+# True if a pyrebase call failed because the token was rejected
+def is_unauthorized(e):
+    for error in [e] + list(getattr(e, 'args', [])):
+        response = getattr(error, 'response', None)
+        if response is not None and getattr(response, 'status_code', None) == 401:
+            return True
+    return False
+
+# Holds the login of a Firebase user and hands out a valid idToken.
+# The token is only refreshed when it is about to expire or has been rejected,
+# so normal database operations cost a single request.
+# With a FirebaseSession the auth requests go through its keep-alive connections,
+# otherwise through pyrebase.
+# With a cache file the login is shared with other processes: a token refreshed by one
+# process is picked up by the others instead of each logging in and refreshing on its own.
+class FirebaseCredentials:
+    def __init__(self, hub, config, name="FIREBASE", session=None, cache_file=None):
+        self.hub = hub
+        self.session = session
+        self.config = config
+        self.name = name
+        self.cache_file = cache_file
+        self.user = None
+        self.expires_at = 0
+        self.lock = threading.RLock()
+        self.stats = {"login": 0, "refresh": 0, "cached": 0, "request": 0, "unauthorized": 0}
+        if cache_file is not None:
+            # Files left by an earlier version may be owned by root
+            for path in (cache_file, cache_file + '.lock'):
+                if os.path.exists(path):
+                    self.set_cache_owner(path)
+
+    # Give a cache file to the owner of its directory, so every process of the device can use it.
+    # Only root can, and needs to, change the owner.
+    def set_cache_owner(self, path, fd=None):
+        if os.geteuid() != 0:
+            return
+        directory = os.stat(os.path.dirname(os.path.abspath(path)))
+        try:
+            if fd is not None:
+                os.fchown(fd, directory.st_uid, directory.st_gid)
+            else:
+                os.chown(path, directory.st_uid, directory.st_gid)
+        except OSError as e:
+            log.warning("{}: Owner of {} not set: {}".format(self.name, path, e))
+
+    # Stop sharing the login, this process logs in on its own
+    def disable_cache(self, reason):
+        log.error("{}: Token cache {} disabled, logging in without sharing the login: {}".format(self.name, self.cache_file, reason))
+        self.cache_file = None
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def set_user(self, user):
+        self.user = user
+        self.expires_at = token_expiry(user['idToken'])
+        if self.expires_at is None:
+            self.expires_at = time.time() + TOKEN_DEFAULT_LIFETIME
+
+    def sign_in(self):
+        if self.session is None:
+            return self.hub.auth().sign_in_with_email_and_password(self.config['user'], self.config['password'])
+        with self.session.operation("auth"):
+            r = self.session.post(SIGN_IN_URL.format(self.config['db_config']['apiKey']),
+                                  json={"email": self.config['user'], "password": self.config['password'], "returnSecureToken": True})
+        r.raise_for_status()
+        return r.json()
+
+    def refresh_user(self, refresh_token):
+        if self.session is None:
+            return self.hub.auth().refresh(refresh_token)
+        with self.session.operation("auth"):
+            r = self.session.post(REFRESH_URL.format(self.config['db_config']['apiKey']),
+                                  data={"grant_type": "refresh_token", "refresh_token": refresh_token})
+        r.raise_for_status()
+        refresh = r.json()
+        return {"idToken": refresh["id_token"], "refreshToken": refresh["refresh_token"]}
+
+    # True if logged in with a token valid for at least TOKEN_EXPIRY_MARGIN
+    def is_valid(self):
+        return self.user is not None and time.time() < self.expires_at - TOKEN_EXPIRY_MARGIN
+
+    # Hold the cache lock while checking and renewing the login, so only one process renews it
+    @contextmanager
+    def cache_lock(self):
+        if self.cache_file is None:
+            yield
+            return
+        try:
+            fd = os.open(self.cache_file + '.lock', os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            self.set_cache_owner(self.cache_file + '.lock', fd)
+            f = os.fdopen(fd, 'a')
+        except OSError as e:
+            # Unlocked use of the cache could lose a refreshed token, so it is not used at all
+            self.disable_cache(e)
+            yield
+            return
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # Take the login from the cache if it is newer than ours
+    # return True if taken
+    def read_cache(self):
+        if self.cache_file is None:
+            return False
+        try:
+            with open(self.cache_file) as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            return False
+        except PermissionError as e:
+            self.disable_cache(e)
+            return False
+        except (OSError, ValueError):
+            return False
+        if cached.get('account') != self.config['user'] or cached.get('expires_at', 0) <= self.expires_at:
+            return False
+        self.user = cached['user']
+        self.expires_at = cached['expires_at']
+        self.stats["cached"] += 1
+        return True
+
+    def write_cache(self):
+        if self.cache_file is None or self.user is None:
+            return
+        cached = {
+            "account":    self.config['user'],
+            "expires_at": self.expires_at,
+            "user":       {key: self.user[key] for key in ('idToken', 'refreshToken', 'localId')},
+        }
+        try:
+            # Tokens are secrets, readable by the owner (and root) only
+            fd = os.open(self.cache_file + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            self.set_cache_owner(self.cache_file + '.tmp', fd)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cached, f)
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+        except OSError as e:
+            log.warning("{}: Token cache not written: {}".format(self.name, e))
+
+    def sign_in_user(self):
+        print("{} login".format(self.name))
+        self.stats["login"] += 1
+        try:
+            self.set_user(self.sign_in())
+        except Exception as e:
+            self.user = None
+            log.error("{}: Login failed at {}: {}".format(self.name, datetime.now(), e))
+
+    def refresh_token(self):
+        self.stats["refresh"] += 1
+        try:
+            refresh = self.refresh_user(self.user['refreshToken'])
+            user = dict(self.user)
+            user['refreshToken'] = refresh['refreshToken']
+            user['idToken'] = refresh['idToken']
+            self.set_user(user)
+        except Exception as e:
+            log.warning("{}: Refresh token failed at {}: {}".format(self.name, datetime.now(), e))
+            self.sign_in_user()
+
+    # Login to Firebase, unless another process has just done it
+    def login(self):
+        with self.lock, self.cache_lock():
+            if not (self.read_cache() and self.is_valid()):
+                self.sign_in_user()
+                self.write_cache()
+            return self.user
+
+    # Refresh Firebase token, unless another process has just done it.
+    # Falls back to a new login if the refresh fails.
+    def refresh(self):
+        with self.lock, self.cache_lock():
+            if not (self.read_cache() and self.is_valid()):
+                if self.user is None:
+                    self.sign_in_user()
+                else:
+                    self.refresh_token()
+                self.write_cache()
+            return self.user
+
+    # Logged in user with a token valid for at least TOKEN_EXPIRY_MARGIN, or None if not logged in
+    def get_user(self):
+        with self.lock:
+            if self.user is None:
+                return self.login()
+            if not self.is_valid():
+                return self.refresh()
+            return self.user
+
+    # Run operation(token), refreshing the token and retrying once if it is rejected
+    # Raises the exception from operation if it fails for other reasons
+    def call(self, operation):
+        user = self.get_user()
+        if user is None:
+            raise Exception("Not logged in")
+        with self.lock:
+            self.stats["request"] += 1
+        try:
+            return operation(user['idToken'])
+        except Exception as e:
+            if not is_unauthorized(e):
+                raise
+            with self.lock:
+                self.stats["unauthorized"] += 1
+                self.stats["request"] += 1
+            user = self.refresh()
+            if user is None:
+                raise
+            return operation(user['idToken'])
@@ -1,6 +1,13 @@
 from device_config import DeviceConfig
+from device_log import setup_logging, fields
+from firebase_auth import FirebaseCredentials, TOKEN_CACHE_FILE
+from firebase_session import FirebaseSession
+from firebase_stream import FirebaseStream
+from heartbeat import ProcessSupervisor
+from log_shipper import LogShipper
 import pyrebase
 import json
+import logging
 import time
 from datetime import datetime
 import json
@@ -8,6 +15,9 @@ import os
 import sys
 import threading
 
+# Keys of the device node read by the rebooter
+REBOOT_KEYS = ['reboot', 'getlog']
+
 class FirebaseRebooter:
     def __init__(self, device_config):
         with open('firebase.json') as f:
@@ -15,36 +25,83 @@ class FirebaseRebooter:
 
         self.deviceid = device_config.deviceid
         self.hub = pyrebase.initialize_app(self.config['db_config'])
-        self.login()
+        self.session = FirebaseSession()
+        self.hub.requests = self.session.session
+        # Login shared with IotDevice through the token cache
+        self.credentials = FirebaseCredentials(self.hub, self.config, name="REBOOTER", session=self.session, cache_file=TOKEN_CACHE_FILE)
+        self.get_user()
+        # Get reboot and getlog pushed from the database instead of polling them
+        self.streams = None
+        if self.config.get('reboot_stream', False):
+            self.streams = [FirebaseStream(self, lambda key=key: self.hub_root + '/' + key, lambda node: None) for key in REBOOT_KEYS]
+            for stream in self.streams:
+                stream.start()
         self.lock = threading.Lock()
+        # Restarts IotDevice if its local heartbeat stops
+        self.supervisor = ProcessSupervisor(device_config.heartbeat_timeout)
+        self.shipping_lock = threading.Lock()
+        self.log_shipper = LogShipper(["iot_log.txt", "rebooter_log.txt"], "logs/" + self.deviceid, self.upload_object)
         print("Started at {}".format(datetime.now()))
 
-        sys.stdout.flush()
-
+    # Logged in user with a valid token, or None
+    def get_user(self):
+        user = self.credentials.get_user()
+        if user is not None:
+            self.hub_root = 'users' + '/' + user['localId'] + '/' + self.deviceid
+        return user
+
+    # Store an object in Firebase Storage
+    def upload_object(self, name, data, content_type):
+        url = "https://firebasestorage.googleapis.com/v0/b/{}/o".format(self.config['db_config']['storageBucket'])
+        def upload(token):
+            r = self.hub.requests.post(url, params={'name': name}, data=data, timeout=60,
+                                       headers={'Authorization': "Firebase " + token, 'Content-Type': content_type})
+            r.raise_for_status()
+        self.credentials.call(upload)
+
+    # Upload log output added since the last upload
     def store_logs(self, name):
-        storage = self.hub.storage()
-
-        storage.child("iot_log.txt").put("iot_log.txt", self.user['idToken'])
-        url = storage.child("iot_log.txt").get_url(self.user['idToken'])
-
-        storage.child("rebooter_log.txt").put("rebooter_log.txt", self.user['idToken'])
-        url = storage.child("rebooter_log.txt").get_url(self.user['idToken'])
-        print("Logs uploaded to cloud at {}".format(datetime.now()))
-
-        sys.stdout.flush()
+        if not self.shipping_lock.acquire(blocking=False):
+            print("Log upload already running at {}".format(datetime.now()))
+            return
+        try:
+            segments = self.log_shipper.ship()
+            print("{} log segments uploaded to cloud at {}".format(segments, datetime.now()))
+        except Exception as e:
+            log.error("Log upload failed at {}: {}".format(datetime.now(), e))
+        finally:
+            self.shipping_lock.release()
+
+    # Restart IotDevice if it has hung or died
+    # return False if it has been restarted too often, or could not be restarted, and the device should be rebooted
+    def supervise(self):
+        reason = self.supervisor.check()
+        if reason is None:
+            return True
+        log.warning(reason)
+        if self.supervisor.restart_limit_reached():
+            log.error("IotDevice restarted too often. Rebooting at {}".format(datetime.now()))
+            return False
+        try:
+            self.supervisor.restart()
+        except Exception:
+            log.exception("IotDevice restart failed. Rebooting at {}".format(datetime.now()))
+            return False
+        return True
 
     def run(self):
         retry = 60
         (self.org_state, self.org_getlogs) = self.read_reboot()
         while self.org_state == None:
-            print("Reboot state fetch failed. Retrying in 10s at {}".format(datetime.now()))
+            log.warning("Reboot state fetch failed. Retrying in 10s at {}".format(datetime.now()))
             time.sleep(10)
             retry -= 1
             if (retry == 0):
-                print("Max number of fails. Rebooting at {}".format(datetime.now()))
+                log.error("Max number of fails. Rebooting at {}".format(datetime.now()))
+                sys.exit()
+            if not self.supervise():
                 sys.exit()
             (self.org_state, self.org_getlogs) = self.read_reboot()
-            sys.stdout.flush()
 
         self.reboot = False
         self.getlogs = True
@@ -56,9 +113,11 @@ class FirebaseRebooter:
         counter = 0
         while True:
             time.sleep(10)
+            if not self.supervise():
+                break
             with self.lock:
                 if (self.reboot == True):
-                    print("Reboot ordered at {}".format(datetime.now()))
+                    log.warning("Reboot ordered at {}".format(datetime.now()))
                     break
                 if (self.getlogs == True):
                     print("Get logs ordered at {}".format(datetime.now()))
@@ -71,16 +130,15 @@ class FirebaseRebooter:
                 else:
                     self.missed_kicks += 1
                     if (self.missed_kicks > 1):
-                        print("Missed kick #{} at {}".format(self.missed_kicks, datetime.now()))
+                        log.warning("Missed kick at {}".format(datetime.now()), extra=fields(missed_kicks=self.missed_kicks))
                     if (self.missed_kicks > 10):
-                        print("Max number of missed kicks. Rebooting at {}".format(datetime.now()))
+                        log.error("Max number of missed kicks. Rebooting at {}".format(datetime.now()))
                         break
             counter += 1
             if (counter > 360):
                 counter = 0
                 print("Alive and kicking at {}".format(datetime.now()))
-
-            sys.stdout.flush()
+                print("REBOOTER: requests {}".format(self.get_stats()))
 
     def reboot_poller(self, name):
         while True:
@@ -98,70 +156,52 @@ class FirebaseRebooter:
                         self.reboot = True
 
     # Read reboot order from cloud
+    # return (reboot, getlog), (None, None) if not available
     def read_reboot(self):
-        #print("FIREBASE: read_state")
-        self.refresh_token()
+        if self.streams is not None:
+            # Values pushed by the streams, no request needed. Not available while a stream is down.
+            if all(stream.connected for stream in self.streams):
+                return tuple(stream.node for stream in self.streams)
+            return (None, None)
 
-        user = self.user
         reboot = None
         getlogs = None
         
-        if user is not None:
+        if self.get_user() is not None:
             try:
-                # Get a reference to the database service
-                db = self.hub.database()
-                
-                reboot = db.child(self.hub_root, 'reboot').get(token=user['idToken']).val()
-                getlogs = db.child(self.hub_root, 'getlog').get(token=user['idToken']).val()
-                #print(new_state)
+                # A shallow read of the device node returns its leaf values (reboot, getlog)
+                # while child nodes like telemetry are only returned as 'true'
+                url = "{}/{}.json".format(self.config['db_config']['databaseURL'], self.hub_root)
+                def get_node(token):
+                    with self.session.operation("get"):
+                        r = self.hub.requests.get(url, params={'auth': token, 'shallow': 'true'})
+                    r.raise_for_status()
+                    return r.json() or {}
+                node = self.credentials.call(get_node)
+                reboot = node.get('reboot')
+                getlogs = node.get('getlog')
             except Exception as e:
-                print("FIREBASE: read_reboot operation failed at {}".format(datetime.now()))
-                print(e)
+                log.error("FIREBASE: read_reboot operation failed at {}: {}".format(datetime.now(), e))
         else:
-            print("Not logged in. Reboot state not fetched at {}".format(datetime.now()))
-        sys.stdout.flush()
+            log.warning("Not logged in. Reboot state not fetched at {}".format(datetime.now()))
 
-        #print("Reboot: " + str(reboot))
-        
         return (reboot, getlogs)
 
-    # Login to Firebase
-    def login(self):
-        # Get a reference to the auth service
-        print("FIREBASE login")
-        try:
-            user = self.hub.auth().sign_in_with_email_and_password(self.config['user'], self.config['password'])
-            self.user = user
-            self.hub_root = 'users' + '/' + user['localId'] + '/' + self.deviceid
-        except Exception as e:
-            self.user = None
-            print("FIREBASE: Login failed at {}".format(datetime.now()))
-            print(e)
-            sys.stdout.flush()
-
-    # Refresh Firebase token to keep connection alive
-    def refresh_token(self):
-        #print("FIREBASE: refresh_token")
-        try:
-            refresh = self.hub.auth().refresh(self.user['refreshToken'])
-            self.user['refreshToken'] = refresh['refreshToken']
-            self.user['idToken'] = refresh['idToken']
-        except Exception as e:
-            print("FIREBASE: Refresh token failed at {}".format(datetime.now()))
-            print(e)
-            sys.stdout.flush()
-            self.login()
-            
+    # Login, token refresh and connection reuse counters
+    def get_stats(self):
+        stats = self.credentials.get_stats()
+        stats["connections"] = self.session.get_stats()
+        return stats
+
 
 # Main program
 device_config = DeviceConfig()
-if device_config.logfile is not None:
-    sys.stdout = open("rebooter_log.txt", "a")
+setup_logging("rebooter_log.txt" if device_config.logfile is not None else None,
+              device_config.log_max_bytes, device_config.log_segments)
+log = logging.getLogger("rebooter")
 
 try:
     hub = FirebaseRebooter(device_config)
     hub.run()
-except Exception as e:
-    print("Exception terminated application at {}".format(datetime.now()))
-    print(e)
-    sys.stdout.flush()
+except Exception:
+    log.exception("Exception terminated application at {}".format(datetime.now()))
@@ -0,0 +1,77 @@
+import threading
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+
+# Timeout in seconds (connect, read) for each kind of Firebase operation
+OPERATION_TIMEOUTS = {
+    "auth": (10, 20),
+    "get":  (10, 20),
+    "set":  (10, 20),
+    "push": (10, 30),
+    "update": (10, 60),
+    "stream": (10, 90),   # Server sends keep-alive every 30 s
+}
+DEFAULT_TIMEOUT = (10, 30)
+
+# Adapter that applies the timeout of the current operation and counts
+# how many requests had to open a new connection (i.e. TLS handshake)
+class CountingHTTPAdapter(HTTPAdapter):
+    def __init__(self, session, **kwargs):
+        self.firebase_session = session
+        super().__init__(**kwargs)
+
+    def count_connections(self):
+        pools = self.poolmanager.pools
+        return sum(pools[key].num_connections for key in list(pools.keys()))
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.firebase_session.get_timeout()
+        opened_before = self.count_connections()
+        try:
+            return super().send(request, timeout=timeout, **kwargs)
+        finally:
+            self.firebase_session.count_request(self.count_connections() - opened_before)
+
+# One keep-alive HTTP session shared by all Firebase auth and database calls
+class FirebaseSession:
+    def __init__(self, pool_size=4):
+        self.session = requests.Session()
+        adapter = CountingHTTPAdapter(self, pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+        for scheme in ('http://', 'https://'):
+            self.session.mount(scheme, adapter)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    # Use as "with session.operation('get'):" around a call to select its timeout
+    @contextmanager
+    def operation(self, name):
+        previous = getattr(self.local, 'operation', None)
+        self.local.operation = name
+        try:
+            yield
+        finally:
+            self.local.operation = previous
+
+    def get_timeout(self):
+        return OPERATION_TIMEOUTS.get(getattr(self.local, 'operation', None), DEFAULT_TIMEOUT)
+
+    def count_request(self, new_connections):
+        name = getattr(self.local, 'operation', None) or "other"
+        with self.lock:
+            stats = self.stats.setdefault(name, {"requests": 0, "new_connections": 0, "reused": 0})
+            stats["requests"] += 1
+            if new_connections > 0:
+                stats["new_connections"] += new_connections
+            else:
+                stats["reused"] += 1
+
+    # Requests, new connections and reused connections per operation
+    def get_stats(self):
+        with self.lock:
+            return {name: dict(stats) for name, stats in self.stats.items()}
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
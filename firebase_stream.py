@@ -0,0 +1,123 @@
+import copy
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+
+log = logging.getLogger("stream")
+
+# Reconnect delay after a failed or closed stream, doubled for every failure up to max
+STREAM_RETRY_MIN = 1
+STREAM_RETRY_MAX = 5*60
+
+# Listens to a Realtime Database node through its server-sent events stream
+# and keeps a local copy of it (a dict, or the value of a leaf node). on_change(node)
+# is called with a copy of the node after every event that changed it.
+class FirebaseStream:
+    def __init__(self, firebase, path, on_change):
+        self.firebase = firebase
+        self.path = path
+        self.on_change = on_change
+        self.node = None
+        self.connected = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        retry_delay = STREAM_RETRY_MIN
+        while True:
+            try:
+                if self.listen():
+                    retry_delay = STREAM_RETRY_MIN
+            except Exception as e:
+                log.warning("FIREBASE: Stream failed at {}: {}".format(datetime.now(), e))
+            self.connected = False
+            time.sleep(retry_delay)
+            retry_delay = min(2 * retry_delay, STREAM_RETRY_MAX)
+
+    # Open the stream and handle events until it is closed
+    # return True if any event was received
+    def listen(self):
+        user = self.firebase.get_user()
+        if user is None:
+            return False
+        url = "{}/{}.json".format(self.firebase.config['db_config']['databaseURL'], self.path())
+        with self.firebase.session.operation("stream"):
+            r = self.firebase.session.session.get(url, params={'auth': user['idToken']},
+                                                  headers={'Accept': 'text/event-stream'}, stream=True)
+        with r:
+            r.raise_for_status()
+            r.encoding = 'utf-8'
+            received = False
+            event = None
+            data = ""
+            for line in r.iter_lines(chunk_size=1, decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:"):
+                    data += line[5:].strip()
+                elif line == "" and event is not None:
+                    received = True
+                    self.connected = True
+                    if not self.handle_event(event, data):
+                        break
+                    event = None
+                    data = ""
+            return received
+
+    # return False if the stream must be reopened
+    def handle_event(self, event, data):
+        if event in ("put", "patch"):
+            message = json.loads(data)
+            self.update_node(event, message["path"], message["data"])
+            if self.node is not None:
+                self.on_change(copy.deepcopy(self.node))
+        elif event == "auth_revoked":
+            # Token expired, reconnect with a fresh one
+            self.firebase.credentials.refresh()
+            return False
+        elif event == "cancel":
+            print("FIREBASE: Stream of {} cancelled by server: {}".format(self.path(), data))
+            return False
+        return True
+
+    def update_node(self, event, path, value):
+        keys = [key for key in path.split("/") if key != ""]
+        if event == "put":
+            if len(keys) == 0:
+                self.node = value
+            else:
+                set_child(self.get_parent(keys), keys[-1], value)
+        elif isinstance(value, dict):
+            if len(keys) == 0:
+                if not isinstance(self.node, dict):
+                    self.node = {}
+                target = self.node
+            else:
+                parent = self.get_parent(keys)
+                if not isinstance(parent.get(keys[-1]), dict):
+                    parent[keys[-1]] = {}
+                target = parent[keys[-1]]
+            for key, child in value.items():
+                set_child(target, key, child)
+
+    # Node containing keys[-1], created if missing
+    def get_parent(self, keys):
+        if not isinstance(self.node, dict):
+            self.node = {}
+        parent = self.node
+        for key in keys[:-1]:
+            if not isinstance(parent.get(key), dict):
+                parent[key] = {}
+            parent = parent[key]
+        return parent
+
+# A null value deletes the key
+def set_child(node, key, value):
+    if value is None:
+        node.pop(key, None)
+    else:
+        node[key] = value
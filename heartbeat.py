@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+# Unix datagram socket the supervisor (the rebooter) listens on
+HEARTBEAT_SOCKET = 'iot_heartbeat.sock'
+
+# Command starting a new IotDevice process.
+# IotDevice runs as root like at boot (run.sh), it loads the w1 modules and sets the sensor resolution.
+# The rebooter runs as a normal user, so this needs a NOPASSWD sudo rule for python3 and kill.
+IOT_DEVICE_COMMAND = ['sudo', '-n', sys.executable, 'IotDevice.py']
+
+# Seconds to wait for a process to exit after SIGTERM before it is killed
+TERMINATE_TIMEOUT = 10
+
+# The device is rebooted if the process has been restarted this many times within the window (s)
+MAX_RESTARTS   = 3
+RESTART_WINDOW = 30*60
+
+log = logging.getLogger("supervisor")
+
+# Sends a heartbeat datagram to the supervisor. Never blocks and never fails,
+# there may be no supervisor listening.
+class HeartbeatSender:
+    def __init__(self, path=HEARTBEAT_SOCKET):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.pid = os.getpid()
+        self.count = 0
+
+    def beat(self, stage="loop"):
+        self.count += 1
+        message = {"pid": self.pid, "count": self.count, "stage": stage}
+        try:
+            self.sock.sendto(json.dumps(message).encode('utf-8'), self.path)
+        except OSError:
+            pass
+
+# Heartbeat of several devices in one process (a gateway). The process only beats when
+# every device has beaten since the last beat, so a single hung device stops the heartbeat.
+class GroupHeartbeat:
+    def __init__(self, sender):
+        self.sender = sender
+        self.lock = threading.Lock()
+        self.members = set()
+        self.waiting = set()
+
+    # Heartbeat sender of one device
+    def member(self, name):
+        with self.lock:
+            self.members.add(name)
+            self.waiting.add(name)
+        return GroupMember(self, name)
+
+    def beat(self, name, stage):
+        with self.lock:
+            self.waiting.discard(name)
+            if len(self.waiting) > 0:
+                return
+            self.waiting = set(self.members)
+        self.sender.beat(stage)
+
+class GroupMember:
+    def __init__(self, group, name):
+        self.group = group
+        self.name = name
+
+    def beat(self, stage="loop"):
+        self.group.beat(self.name, stage)
+
+# Receives the heartbeats of IotDevice and restarts it when it has hung or died.
+# A process is only supervised after its first heartbeat.
+class ProcessSupervisor:
+    def __init__(self, timeout, path=HEARTBEAT_SOCKET, command=IOT_DEVICE_COMMAND):
+        self.timeout = timeout
+        self.path = path
+        self.command = command
+        self.lock = threading.Lock()
+        self.pid = None
+        self.stage = None
+        self.last_beat = None
+        self.process = None
+        self.restarts = []
+        if os.path.exists(path):
+            os.remove(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        # IotDevice may run as another user
+        os.chmod(path, 0o666)
+        self.thread = threading.Thread(target=self.receiver, daemon=True)
+        self.thread.start()
+
+    def receiver(self):
+        while True:
+            try:
+                message = json.loads(self.sock.recv(1024))
+            except (OSError, ValueError) as e:
+                print("Bad heartbeat: {}".format(e))
+                continue
+            with self.lock:
+                if message["pid"] != self.pid:
+                    print("Supervising IotDevice pid {} at {}".format(message["pid"], datetime.now()))
+                self.pid = message["pid"]
+                self.stage = message.get("stage")
+                self.last_beat = time.monotonic()
+
+    def is_running(self, pid):
+        if self.process is not None and self.process.pid == pid:
+            return self.process.poll() is None
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    # return reason the process needs a restart, or None
+    def check(self):
+        with self.lock:
+            if self.pid is None:
+                return None
+            if not self.is_running(self.pid):
+                return "IotDevice pid {} has exited".format(self.pid)
+            silent = time.monotonic() - self.last_beat
+            if silent > self.timeout:
+                return "No heartbeat from IotDevice pid {} for {:.0f} s (last stage '{}')".format(self.pid, silent, self.stage)
+            return None
+
+    # True if the process has been restarted too often and the device should be rebooted
+    def restart_limit_reached(self):
+        now = time.monotonic()
+        self.restarts = [at for at in self.restarts if now - at < RESTART_WINDOW]
+        return len(self.restarts) >= MAX_RESTARTS
+
+    # Send a signal to a process. A process of another user (IotDevice runs as root) is signalled through sudo.
+    # Raises PermissionError if the signal can not be sent
+    def send_signal(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            result = subprocess.run(['sudo', '-n', 'kill', '-s', sig.name[3:], str(pid)], stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if result.returncode != 0 and self.is_running(pid):
+                raise PermissionError("Not allowed to send {} to IotDevice pid {}, it runs as another user "
+                                      "and sudo failed: {}".format(sig.name, pid, result.stderr.decode(errors='replace').strip()))
+
+    def terminate(self, pid):
+        self.send_signal(pid, signal.SIGTERM)
+        deadline = time.monotonic() + TERMINATE_TIMEOUT
+        while self.is_running(pid):
+            if time.monotonic() > deadline:
+                self.send_signal(pid, signal.SIGKILL)
+                break
+            time.sleep(0.2)
+        if self.process is not None:
+            # The started process is sudo, it exits with IotDevice
+            try:
+                self.process.wait(TERMINATE_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                log.warning("Started process {} did not exit".format(self.process.pid))
+
+    # Log what the started process writes before its own logging is set up, like import errors
+    def forward_output(self, process):
+        for line in process.stdout:
+            line = line.decode('utf-8', 'replace').rstrip()
+            if line:
+                log.warning("IotDevice pid {}: {}".format(process.pid, line))
+
+    # Stop the process if it is still there and start a new one
+    # Raises an exception if the process can not be stopped or started
+    def restart(self):
+        with self.lock:
+            pid = self.pid
+        self.terminate(pid)
+        self.process = subprocess.Popen(self.command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, start_new_session=True)
+        threading.Thread(target=self.forward_output, args=(self.process,), daemon=True).start()
+        with self.lock:
+            # The new process gets a full timeout to send its first heartbeat
+            self.pid = self.process.pid
+            self.stage = "restarted"
+            self.last_beat = time.monotonic()
+        self.restarts.append(time.monotonic())
+        print("Restarted IotDevice as pid {} at {}".format(self.process.pid, datetime.now()))
@@ -0,0 +1,161 @@
+import hashlib
+import logging
+import os
+import struct
+import sys
+from array import array
+
+log = logging.getLogger("ir_codes")
+
+IR_CONF_FILE = 'lg_ac.conf'
+
+# Binary cache: magic, sha256 of the conf file, number of codes,
+# then for each code: name length, name, number of pulses, pulses (uint16)
+CACHE_MAGIC = b'IRC1'
+
+# LG AC protocol: header mark/space, then 28 bits where a long space is a 1
+LG_HEADER_MARK = 8900
+LG_BITS        = 28
+LG_ONE_SPACE   = 1000   # Spaces longer than this are 1 bits
+LG_SIGNATURE   = 0x88
+LG_MODES = { 8: "AC", 12: "HEAT", 11: "AI", 9: "DEHUM" }
+LG_FANS  = { 0: "LOW", 2: "MID", 4: "HIGH", 5: "CHAOS" }
+
+# Parse the raw_codes section of a lircd.conf
+# return {name: array of pulse/space lengths in us}
+def parse_lirc_conf(path):
+    codes = {}
+    name = None
+    in_raw_codes = False
+    with open(path) as f:
+        for line in f:
+            tokens = line.split('#')[0].split()
+            if len(tokens) == 0:
+                continue
+            if tokens[0] == 'begin' and tokens[1:2] == ['raw_codes']:
+                in_raw_codes = True
+            elif tokens[0] == 'end' and tokens[1:2] == ['raw_codes']:
+                in_raw_codes = False
+                name = None
+            elif in_raw_codes and tokens[0] == 'name':
+                name = tokens[1]
+                codes[name] = array('H')
+            elif in_raw_codes and name is not None:
+                codes[name].extend(int(token) for token in tokens)
+    return codes
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+def write_cache(path, digest, codes):
+    parts = [CACHE_MAGIC, digest, struct.pack('<H', len(codes))]
+    for name, pulses in codes.items():
+        encoded = name.encode('ascii')
+        parts.append(struct.pack('<B', len(encoded)) + encoded + struct.pack('<H', len(pulses)))
+        pulses = array('H', pulses)
+        if sys.byteorder != 'little':
+            pulses.byteswap()
+        parts.append(pulses.tobytes())
+    with open(path + '.tmp', 'wb') as f:
+        f.write(b''.join(parts))
+    os.replace(path + '.tmp', path)
+
+# return {name: pulses}, or None if the cache is missing or not made from a file with digest
+def read_cache(path, digest):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if data[:4] != CACHE_MAGIC or data[4:36] != digest:
+        return None
+    codes = {}
+    (count,) = struct.unpack_from('<H', data, 36)
+    offset = 38
+    for i in range(count):
+        name_length = data[offset]
+        name = data[offset + 1:offset + 1 + name_length].decode('ascii')
+        offset += 1 + name_length
+        (pulse_count,) = struct.unpack_from('<H', data, offset)
+        offset += 2
+        pulses = array('H')
+        pulses.frombytes(data[offset:offset + 2 * pulse_count])
+        if sys.byteorder != 'little':
+            pulses.byteswap()
+        codes[name] = pulses
+        offset += 2 * pulse_count
+    return codes
+
+# Decode a raw LG AC pulse train
+# return {"power", "mode", "temp", "fan", "checksum_ok"} or None if not an LG frame
+def decode_lg(pulses):
+    if len(pulses) < 2 + 2 * LG_BITS or abs(pulses[0] - LG_HEADER_MARK) > LG_HEADER_MARK // 4:
+        return None
+    value = 0
+    for i in range(LG_BITS):
+        value = (value << 1) | (pulses[3 + 2 * i] > LG_ONE_SPACE)
+    nibbles = [(value >> shift) & 0xF for shift in range(24, -1, -4)]
+    if (value >> 20) != LG_SIGNATURE:
+        return None
+    power, mode, temp, fan, checksum = nibbles[2:]
+    return {
+        "power":       power,
+        "mode":        LG_MODES.get(mode, mode),
+        "temp":        temp + 15,
+        "fan":         LG_FANS.get(fan, fan),
+        "checksum_ok": (power + mode + temp + fan) & 0xF == checksum,
+    }
+
+# IR codes of lg_ac.conf compiled once into a table of name -> pulses.
+# The compiled table is cached next to the conf file and rebuilt when the file changes.
+class IrCodeTable:
+    def __init__(self, conf_file=IR_CONF_FILE, cache_file=None):
+        if cache_file is None:
+            cache_file = conf_file + '.cache'
+        digest = file_digest(conf_file)
+        self.codes = read_cache(cache_file, digest)
+        if self.codes is None:
+            self.codes = parse_lirc_conf(conf_file)
+            try:
+                write_cache(cache_file, digest, self.codes)
+            except OSError as e:
+                log.warning("Could not cache IR codes: {}".format(e))
+
+    def __contains__(self, name):
+        return name in self.codes
+
+    def __getitem__(self, name):
+        return self.codes[name]
+
+    def __len__(self):
+        return len(self.codes)
+
+    # Check that codes named MODE_FAN[_TEMP] decode to that mode, fan and temp
+    # return list of problems found
+    def check_consistency(self):
+        problems = []
+        for name, pulses in self.codes.items():
+            decoded = decode_lg(pulses)
+            if decoded is None:
+                problems.append("{}: not an LG frame".format(name))
+                continue
+            if not decoded["checksum_ok"]:
+                problems.append("{}: bad checksum".format(name))
+            parts = name.split('_')
+            if parts[0] in LG_MODES.values() and len(parts) >= 2 and parts[1] in LG_FANS.values():
+                expected = {"power": 0, "mode": parts[0], "fan": parts[1]}
+                if len(parts) == 3:
+                    expected["temp"] = int(parts[2])
+                for key, value in expected.items():
+                    if decoded[key] != value:
+                        problems.append("{}: {} is {}".format(name, key, decoded[key]))
+        return problems
+
+if __name__ == '__main__':
+    table = IrCodeTable()
+    print("{} IR codes".format(len(table)))
+    for problem in table.check_consistency():
+        print(problem)
+    for name in sys.argv[1:]:
+        print("{}: {}".format(name, decode_lg(table[name])))
@@ -0,0 +1,89 @@
+import socket
+import threading
+
+LIRCD_SOCKET = '/var/run/lirc/lircd'
+# Seconds to wait for lircd to answer a command (it answers after the code has been sent)
+LIRCD_TIMEOUT = 5
+
+class LircError(Exception):
+    pass
+
+# Client for the lircd Unix socket protocol, replaces forking irsend for every code.
+# A command is answered by a reply packet:
+#   BEGIN / <command> / SUCCESS or ERROR / [DATA / <n> / <n lines>] / END
+class LircClient:
+    def __init__(self, socket_path=LIRCD_SOCKET, timeout=LIRCD_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = b""
+        self.lock = threading.Lock()
+
+    def connect(self):
+        self.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+        self.buffer = b""
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def read_line(self):
+        while b"\n" not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise LircError("lircd closed the connection")
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line.decode('ascii', 'replace').strip()
+
+    # Read packets until the reply to command
+    # return (success, data lines)
+    def read_reply(self, command):
+        while True:
+            while self.read_line() != "BEGIN":
+                pass
+            echoed = self.read_line()
+            lines = []
+            line = self.read_line()
+            while line != "END":
+                lines.append(line)
+                line = self.read_line()
+            # Broadcasts like SIGHUP can arrive before the reply
+            if echoed != command:
+                continue
+            success = len(lines) > 0 and lines[0] == "SUCCESS"
+            data = []
+            if "DATA" in lines:
+                i = lines.index("DATA")
+                data = lines[i + 2:i + 2 + int(lines[i + 1])]
+            return success, data
+
+    # Send a command and wait for its reply, reconnecting once if the connection is lost
+    # return data lines of the reply, raises LircError if lircd answers ERROR
+    def command(self, command):
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    self.sock.sendall((command + "\n").encode('ascii'))
+                    success, data = self.read_reply(command)
+                    break
+                except (OSError, LircError) as e:
+                    self.close()
+                    if attempt == 1:
+                        raise LircError("lircd command '{}' failed: {}".format(command, e))
+        if not success:
+            raise LircError("lircd command '{}' failed: {}".format(command, " ".join(data)))
+        return data
+
+    def send_once(self, remote, code):
+        self.command("SEND_ONCE {} {}".format(remote, code))
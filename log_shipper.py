@@ -0,0 +1,105 @@
+import gzip
+import json
+import logging
+import os
+from common import Common
+
+LOG_SHIPPER_STATE_FILE = 'log_shipper.json'
+# Segments listed in the manifest of each log, older ones are dropped from it
+LOG_MANIFEST_SEGMENTS = 100
+
+logger = logging.getLogger("shipper")
+
+# Ships only the log output added since the last shipping, gzipped into numbered segments.
+# Remembers inode and byte offset of each log, so a log rotated by device_log since the
+# last shipping is read from the rotated file (log.1, log.2...) first.
+# The manifest lists the segments of every log in order for stitching them together.
+class LogShipper:
+    # upload(object name, bytes, content type) stores an object in the cloud
+    def __init__(self, logs, prefix, upload, state_file=LOG_SHIPPER_STATE_FILE):
+        self.logs = logs
+        self.prefix = prefix
+        self.upload = upload
+        self.state_file = state_file
+        try:
+            with open(state_file) as f:
+                self.state = json.load(f)
+        except Exception:
+            self.state = {}
+
+    def save_state(self):
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.replace(self.state_file + '.tmp', self.state_file)
+
+    # Files of a log, newest first
+    def log_files(self, log):
+        files = [log]
+        i = 1
+        while os.path.exists("{}.{}".format(log, i)):
+            files.append("{}.{}".format(log, i))
+            i += 1
+        return files
+
+    # Bytes written to log since the last shipping, ending with a complete line
+    # return (data, inode of current file, offset in current file, True if output was lost to rotation)
+    def read_new(self, log, state):
+        files = [path for path in self.log_files(log) if os.path.exists(path)]
+        inodes = [os.stat(path).st_ino for path in files]
+        if len(files) == 0:
+            return b"", None, 0, False
+        if state.get("inode") in inodes and os.path.getsize(files[inodes.index(state["inode"])]) >= state["offset"]:
+            start = inodes.index(state["inode"])
+            offset = state["offset"]
+            gap = False
+        else:
+            # First shipping, or the shipped file has been rotated away or truncated
+            start = 0 if "inode" not in state else len(files) - 1
+            offset = 0
+            gap = "inode" in state
+        parts = []
+        for i in range(start, -1, -1):
+            with open(files[i], 'rb') as f:
+                f.seek(offset if i == start else 0)
+                parts.append(f.read())
+        data = b"".join(parts)
+        # The writer may be in the middle of a line
+        current_end = len(parts[-1])
+        if not data.endswith(b"\n"):
+            cut = len(data) - (data.rfind(b"\n") + 1)
+            data = data[:len(data) - cut]
+            current_end = max(0, current_end - cut)
+        current_offset = (offset if start == 0 else 0) + current_end
+        return data, inodes[0], current_offset, gap
+
+    # Upload new output of all logs, then the manifest
+    # return number of segments uploaded
+    def ship(self):
+        uploaded = 0
+        for log in self.logs:
+            state = self.state.setdefault(log, {"segment": 0, "segments": []})
+            data, inode, offset, gap = self.read_new(log, state)
+            if len(data) == 0:
+                continue
+            compressed = gzip.compress(data)
+            name = "{}/{}/{:06d}.gz".format(self.prefix, log, state["segment"] + 1)
+            self.upload(name, compressed, "application/gzip")
+            state["segment"] += 1
+            state["inode"] = inode
+            state["offset"] = offset
+            state["segments"] = (state["segments"] + [{
+                "name":        name,
+                "bytes":       len(data),
+                "gzipBytes":   len(compressed),
+                "gap":         gap,
+                "utctime":     Common.getCurrentUTCTime(),
+            }])[-LOG_MANIFEST_SEGMENTS:]
+            self.save_state()
+            uploaded += 1
+            if gap:
+                logger.warning("Output of {} was rotated away before it was shipped, segment {} follows a gap".format(log, name))
+            logger.info("Shipped {} bytes of {} as {} ({} bytes)".format(len(data), log, name, len(compressed)))
+        if uploaded > 0:
+            manifest = {log: self.state[log]["segments"] for log in self.logs if log in self.state}
+            self.upload("{}/manifest.json".format(self.prefix), json.dumps(manifest).encode('utf-8'), "application/json")
+        return uploaded
@@ -1,9 +1,8 @@
 #!/bin/bash
 cd /home/anders/gundbyniot
 
+# rebooter_log.txt is rotated by the application (log_max_bytes, log_segments)
 touch rebooter_log.txt
-tail -n 1000 rebooter_log.txt > rlog.tmp
-mv -f rlog.tmp rebooter_log.txt
 chmod 666 rebooter_log.txt
 
 echo >> rebooter_log.txt
@@ -14,6 +13,8 @@ date >> rebooter_log.txt
 sleep 120
 
 # Run application
+# It restarts a hung IotDevice as root like run.sh, through sudo, so anders needs a
+# NOPASSWD sudoers rule for /usr/bin/python3 and kill (the default on Raspberry Pi OS)
 sudo -u anders /usr/bin/python3 firebase_rebooter.py
 
 echo "REBOOTING" >> rebooter_log.txt
@@ -1,18 +1,13 @@
 #!/bin/bash
 cd /home/anders/gundbyniot
 
-tail -n 1000 iot_log.txt > log.tmp
-mv -f log.tmp iot_log.txt
-
+# iot_log.txt is rotated by the application (log_max_bytes, log_segments)
 echo >> iot_log.txt
 echo "BOOTING APPLICATION" >> iot_log.txt
 date >> iot_log.txt
 
-# Wait for startup
-sleep 120
-
 ip link >> iot_log.txt
 
-# Run application
+# Run application, it waits until the cloud can be reached (network_deadline in device_config.json)
 echo "STARTING APPLICATION" >> iot_log.txt
 /usr/bin/python3 IotDevice.py&
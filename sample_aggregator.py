@@ -0,0 +1,123 @@
+import math
+from bisect import insort
+
+# The P-square markers need many samples to move to the percentile, up to this many
+# samples are kept and the percentile is exact
+EXACT_SAMPLES = 50
+
+# Streaming estimate of one percentile with the P-square algorithm (Jain & Chlamtac, 1985).
+# Exact over the first EXACT_SAMPLES samples, then the five markers start at the exact
+# percentiles of those samples. Memory is constant regardless of the number of samples.
+class P2Quantile:
+    def __init__(self, percentile):
+        self.p = percentile / 100.0
+        self.samples = []                 # Sorted samples until the markers are initialised
+        self.heights = None
+        self.increments = [0, self.p / 2, self.p, (1 + self.p) / 2, 1]
+
+    # Start the markers at the desired positions in the sorted samples
+    def init_markers(self):
+        n = len(self.samples)
+        p = self.p
+        self.desired = [1, 1 + (n - 1) * p / 2, 1 + (n - 1) * p, 1 + (n - 1) * (1 + p) / 2, n]
+        self.positions = [1]
+        for i in range(1, 4):
+            self.positions.append(max(self.positions[i - 1] + 1, min(int(round(self.desired[i])), n - 4 + i)))
+        self.positions.append(n)
+        self.heights = [self.samples[position - 1] for position in self.positions]
+        self.samples = None
+
+    def add(self, x):
+        if self.heights is None:
+            insort(self.samples, x)
+            if len(self.samples) >= EXACT_SAMPLES:
+                self.init_markers()
+            return
+        heights = self.heights
+
+        if x < heights[0]:
+            heights[0] = x
+            k = 0
+        elif x >= heights[4]:
+            heights[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= heights[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            self.positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # Adjust the three middle markers towards their desired positions
+        for i in range(1, 4):
+            d = self.desired[i] - self.positions[i]
+            if (d >= 1 and self.positions[i + 1] - self.positions[i] > 1) or \
+               (d <= -1 and self.positions[i - 1] - self.positions[i] < -1):
+                d = int(math.copysign(1, d))
+                height = self.parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self.linear(i, d)
+                heights[i] = height
+                self.positions[i] += d
+
+    def parabolic(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def linear(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+
+    def value(self):
+        if self.heights is None:
+            if len(self.samples) == 0:
+                return None
+            # Exact percentile of the samples seen
+            return self.samples[int(round(self.p * (len(self.samples) - 1)))]
+        return self.heights[2]
+
+# Summary of the samples of one reporting interval, computed in a single streaming pass
+class SampleAggregator:
+    def __init__(self, percentiles=(10, 50, 90)):
+        self.percentiles = list(percentiles)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.last = None
+        self.quantiles = [P2Quantile(p) for p in self.percentiles]
+
+    def add(self, x):
+        self.count += 1
+        self.sum += x
+        self.last = x
+        if self.min is None or x < self.min:
+            self.min = x
+        if self.max is None or x > self.max:
+            self.max = x
+        for quantile in self.quantiles:
+            quantile.add(x)
+
+    # Summary of the samples added since the last call, or None if there were none.
+    # Starts a new interval.
+    def take_summary(self):
+        if self.count == 0:
+            return None
+        summary = {
+            "count": self.count,
+            "min":   round(self.min, 2),
+            "max":   round(self.max, 2),
+            "mean":  round(self.sum / self.count, 2),
+            "last":  round(self.last, 2),
+        }
+        for p, quantile in zip(self.percentiles, self.quantiles):
+            summary["p{}".format(p)] = round(quantile.value(), 2)
+        self.reset()
+        return summary
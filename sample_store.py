@@ -0,0 +1,204 @@
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import namedtuple
+from datetime import datetime
+
+SAMPLE_STORE_FILE = 'samples.ring'
+
+# Header: magic, record size, capacity, reported_until (time of the last sample in a telemetry summary)
+HEADER_FORMAT = '<4sIId'
+HEADER_MAGIC  = b'SMP1'
+HEADER_SIZE   = 64
+REPORTED_UNTIL_OFFSET = 12
+
+# Record: seq, time, sensor id, value, setpoint, AC active, crc32 of the preceding bytes.
+# seq counts appends from 1 and a record lives in slot (seq - 1) % capacity, seq 0 is an empty slot.
+RECORD = struct.Struct('<Qd16sffB3xI')
+RECORD_CRC_OFFSET = RECORD.size - 4
+
+# Dirty records are written to the SD card at least this often (s)
+SAMPLE_STORE_FLUSH_INTERVAL = 60
+
+Sample = namedtuple('Sample', ['time', 'sensor', 'value', 'setpoint', 'ac_active'])
+
+# Fixed size ring of sensor samples in a memory mapped file.
+# An append packs one record into its slot in the map, the kernel writes it back to the file.
+# The write position is not stored; on open it is the valid record with the highest seq.
+# A record torn by a power loss fails its crc, and a slot whose page was never written
+# back holds a seq that does not match the slot, so both are skipped and nothing else is lost.
+class SampleStore:
+    # capacity None opens an existing store read as it is (sample_store.py CLI): a missing or
+    # invalid store raises an exception and is never replaced or changed
+    def __init__(self, capacity=None, path=SAMPLE_STORE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        old_samples = None
+        mapped = False
+        if os.path.exists(path):
+            self.open_map()
+            mapped = True
+            if not self.header_ok():
+                self.close()
+                mapped = False
+                if capacity is None:
+                    raise Exception("Sample store {} is not valid".format(path))
+                print("Sample store {} is not valid, starting a new one".format(path))
+                os.remove(path)
+            elif capacity is None:
+                capacity = self.file_capacity()
+            elif self.file_capacity() != capacity:
+                # Retention or number of sensors changed, move the newest samples to a new ring
+                self.capacity = self.file_capacity()
+                self.seq = self.find_last_seq()
+                reported_until = self.reported_until()
+                old_samples = self.query()
+                self.close()
+                mapped = False
+                os.remove(path)
+        if capacity is None:
+            raise Exception("Sample store {} does not exist".format(path))
+        self.capacity = max(1, capacity)
+        if not mapped:
+            self.create()
+            self.open_map()
+        self.seq = self.find_last_seq()
+        self.flushed_seq = self.seq
+        self.flushed_at = time.monotonic()
+        if old_samples is not None:
+            for sample in old_samples[-self.capacity:]:
+                self.append(*sample)
+            self.mark_reported(reported_until)
+
+    def create(self):
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(struct.pack(HEADER_FORMAT, HEADER_MAGIC, RECORD.size, self.capacity, 0.0).ljust(HEADER_SIZE, b'\0'))
+            f.truncate(HEADER_SIZE + self.capacity * RECORD.size)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
+
+    def open_map(self):
+        with open(self.path, 'r+b') as f:
+            self.map = mmap.mmap(f.fileno(), 0)
+        self.view = memoryview(self.map)
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+
+    def header_ok(self):
+        if len(self.map) < HEADER_SIZE:
+            return False
+        magic, record_size, capacity, reported_until = struct.unpack_from(HEADER_FORMAT, self.map)
+        return magic == HEADER_MAGIC and record_size == RECORD.size and len(self.map) == HEADER_SIZE + capacity * RECORD.size
+
+    def file_capacity(self):
+        return struct.unpack_from(HEADER_FORMAT, self.map)[2]
+
+    def slot_offset(self, seq):
+        return HEADER_SIZE + ((seq - 1) % self.capacity) * RECORD.size
+
+    # return True if the slot holds an intact record with this seq
+    def record_ok(self, offset, seq, crc):
+        return seq > 0 and self.slot_offset(seq) == offset and zlib.crc32(self.view[offset:offset + RECORD_CRC_OFFSET]) == crc
+
+    def find_last_seq(self):
+        last_seq = 0
+        offset = HEADER_SIZE
+        for record in RECORD.iter_unpack(self.view[HEADER_SIZE:]):
+            if record[0] > last_seq and self.record_ok(offset, record[0], record[-1]):
+                last_seq = record[0]
+            offset += RECORD.size
+        return last_seq
+
+    def __len__(self):
+        return min(self.seq, self.capacity)
+
+    # Store a sample. Packs the record straight into the map, O(1) and no file I/O.
+    def append(self, timestamp, sensor, value, setpoint=None, ac_active=False):
+        if setpoint is None:
+            setpoint = float('nan')
+        with self.lock:
+            seq = self.seq + 1
+            offset = self.slot_offset(seq)
+            RECORD.pack_into(self.map, offset, seq, timestamp, sensor.encode('ascii'), value, setpoint, ac_active, 0)
+            struct.pack_into('<I', self.map, offset + RECORD_CRC_OFFSET, zlib.crc32(self.view[offset:offset + RECORD_CRC_OFFSET]))
+            self.seq = seq
+            if time.monotonic() - self.flushed_at > SAMPLE_STORE_FLUSH_INTERVAL:
+                self.flush()
+
+    # Write records appended since the last flush to the file
+    def flush(self):
+        if self.seq == self.flushed_seq:
+            return
+        first = self.slot_offset(self.flushed_seq + 1)
+        last = self.slot_offset(self.seq) + RECORD.size
+        if self.seq - self.flushed_seq >= self.capacity or last <= first:
+            # Wrapped around the end of the ring
+            self.map.flush()
+        else:
+            start = first - first % mmap.ALLOCATIONGRANULARITY
+            self.map.flush(start, last - start)
+        self.flushed_seq = self.seq
+        self.flushed_at = time.monotonic()
+
+    # Samples with from_time <= time < to_time, oldest first.
+    # from_time/to_time are epoch seconds, None is unbounded. sensor None returns all sensors.
+    # return [Sample]
+    def query(self, from_time=None, to_time=None, sensor=None):
+        if sensor is not None:
+            sensor = sensor.encode('ascii')
+        with self.lock:
+            first_seq = max(1, self.seq - self.capacity + 1)
+            samples = []
+            for seq in (first_seq, self.slot_start_seq(first_seq)):
+                if seq > self.seq:
+                    continue
+                # Records from slot of seq to the end of the ring or to the newest record
+                count = min(self.seq - seq + 1, self.capacity - (seq - 1) % self.capacity)
+                offset = self.slot_offset(seq)
+                for record in RECORD.iter_unpack(self.view[offset:offset + count * RECORD.size]):
+                    record_seq, timestamp, record_sensor, value, setpoint, ac_active, crc = record
+                    if (record_seq == seq and
+                            (from_time is None or timestamp >= from_time) and
+                            (to_time is None or timestamp < to_time) and
+                            (sensor is None or record_sensor.rstrip(b'\0') == sensor) and
+                            zlib.crc32(self.view[offset:offset + RECORD_CRC_OFFSET]) == crc):
+                        samples.append(Sample(timestamp, record_sensor.rstrip(b'\0').decode('ascii'), value,
+                                              None if setpoint != setpoint else setpoint, bool(ac_active)))
+                    seq += 1
+                    offset += RECORD.size
+        return samples
+
+    # First seq stored in slot 0 after first_seq, where a query wraps around
+    def slot_start_seq(self, first_seq):
+        return first_seq + self.capacity - (first_seq - 1) % self.capacity
+
+    # Time of the last sample included in a telemetry summary, 0 if none
+    def reported_until(self):
+        return struct.unpack_from('<d', self.map, REPORTED_UNTIL_OFFSET)[0]
+
+    def mark_reported(self, timestamp):
+        with self.lock:
+            struct.pack_into('<d', self.map, REPORTED_UNTIL_OFFSET, timestamp)
+
+# List stored samples: python3 sample_store.py [hours] [sensor]
+if __name__ == '__main__':
+    from sample_aggregator import SampleAggregator
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 1
+    sensor = sys.argv[2] if len(sys.argv) > 2 else None
+    store = SampleStore()
+    samples = store.query(time.time() - hours * 3600, sensor=sensor)
+    aggregators = {}
+    for sample in samples:
+        print("{} {:16s} {:6.2f} setpoint {} {}".format(datetime.fromtimestamp(sample.time).strftime("%Y-%m-%d %H:%M:%S"),
+              sample.sensor, sample.value, sample.setpoint, "AC" if sample.ac_active else ""))
+        aggregators.setdefault(sample.sensor, SampleAggregator()).add(sample.value)
+    print("{} of {} stored samples in the last {} h".format(len(samples), len(store), hours))
+    for sensor, aggregator in aggregators.items():
+        print("{}: {}".format(sensor, aggregator.take_summary()))
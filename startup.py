@@ -0,0 +1,75 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+# Max seconds to wait for the network before starting anyway
+NETWORK_DEADLINE = 120
+# Seconds between and timeout of connection attempts while waiting for the network
+PROBE_INTERVAL = 1
+PROBE_TIMEOUT  = 3
+
+log = logging.getLogger("startup")
+
+# Seconds since boot, or None if not known
+def uptime():
+    try:
+        with open('/proc/uptime') as f:
+            return float(f.read().split()[0])
+    except (OSError, ValueError):
+        return None
+
+# Seconds from boot until this process was started, or None if not known
+def process_start_uptime():
+    try:
+        with open('/proc/self/stat') as f:
+            # Fields after the command name, starttime is field 22
+            fields = f.read().rsplit(')', 1)[1].split()
+        return int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+# Wait until host resolves and accepts a TCP connection on port, at most deadline seconds
+# on_probe() is called before every attempt, e.g. to send a heartbeat to the supervisor
+# return True if the network is ready
+def wait_for_network(host, port, deadline=NETWORK_DEADLINE, on_probe=None):
+    give_up_at = time.monotonic() + deadline
+    while True:
+        if on_probe is not None:
+            on_probe()
+        try:
+            with socket.create_connection((host, port), timeout=PROBE_TIMEOUT):
+                return True
+        except OSError as e:
+            error = e
+        if time.monotonic() > give_up_at:
+            log.warning("Network not ready after {} s, starting anyway: {}".format(deadline, error))
+            return False
+        time.sleep(PROBE_INTERVAL)
+
+# Times of the startup milestones, in seconds since boot
+# (or since the report was created if the boot time is not known)
+class StartupReport:
+    def __init__(self):
+        self.lock = threading.Lock()
+        now = uptime()
+        self.offset = now - time.monotonic() if now is not None else -time.monotonic()
+        self.milestones = {}
+        started = process_start_uptime()
+        if started is not None and now is not None:
+            self.milestones["processStart"] = round(started, 1)
+
+    # Record the first time a milestone is reached
+    def mark(self, name):
+        with self.lock:
+            if name not in self.milestones:
+                self.milestones[name] = round(time.monotonic() + self.offset, 1)
+
+    def get_report(self):
+        with self.lock:
+            return dict(self.milestones)
+
+    def log(self):
+        report = self.get_report()
+        print("Startup (s since boot): {}".format(", ".join("{} {}".format(name, at) for name, at in report.items())))
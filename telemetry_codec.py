@@ -0,0 +1,150 @@
+import gzip
+import json
+import struct
+import time
+from datetime import datetime
+
+try:
+    # Faster C implementation if installed
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Wire formats for telemetry messages: name -> content type
+CONTENT_TYPES = {
+    "json":    "application/json",
+    "cbor":    "application/cbor",
+    "msgpack": "application/msgpack",
+}
+
+# Minimal CBOR (RFC 8949) encoder for the types used in telemetry
+def cbor_head(major, value):
+    if value < 24:
+        return bytes([(major << 5) | value])
+    if value < 0x100:
+        return struct.pack('>BB', (major << 5) | 24, value)
+    if value < 0x10000:
+        return struct.pack('>BH', (major << 5) | 25, value)
+    if value < 0x100000000:
+        return struct.pack('>BI', (major << 5) | 26, value)
+    return struct.pack('>BQ', (major << 5) | 27, value)
+
+def cbor_encode(obj, out=None):
+    if out is None:
+        out = bytearray()
+        cbor_encode(obj, out)
+        return bytes(out)
+    if obj is None:
+        out.append(0xf6)
+    elif obj is True:
+        out.append(0xf5)
+    elif obj is False:
+        out.append(0xf4)
+    elif isinstance(obj, int):
+        if obj >= 0:
+            out += cbor_head(0, obj)
+        else:
+            out += cbor_head(1, -1 - obj)
+    elif isinstance(obj, float):
+        # Shortest float that holds the value exactly
+        for code, fmt in ((0xf9, '>e'), (0xfa, '>f')):
+            try:
+                if struct.unpack(fmt, struct.pack(fmt, obj))[0] == obj:
+                    out += struct.pack('>B', code) + struct.pack(fmt, obj)
+                    return
+            except (OverflowError, struct.error):
+                pass
+        out += struct.pack('>Bd', 0xfb, obj)
+    elif isinstance(obj, str):
+        encoded = obj.encode('utf-8')
+        out += cbor_head(3, len(encoded)) + encoded
+    elif isinstance(obj, (bytes, bytearray)):
+        out += cbor_head(2, len(obj)) + obj
+    elif isinstance(obj, (list, tuple)):
+        out += cbor_head(4, len(obj))
+        for item in obj:
+            cbor_encode(item, out)
+    elif isinstance(obj, dict):
+        out += cbor_head(5, len(obj))
+        for key, value in obj.items():
+            cbor_encode(key, out)
+            cbor_encode(value, out)
+    else:
+        raise TypeError("Can not CBOR encode {}".format(type(obj)))
+
+# Replace ISO time strings (keys ending with 'utctime') by integer epoch seconds.
+# Common.getCurrentUTCTime() writes the local time of the device with a "Z" suffix,
+# so the strings are converted as local time to get the real epoch.
+def epoch_timestamps(obj):
+    if isinstance(obj, list):
+        return [epoch_timestamps(item) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    converted = {}
+    for key, value in obj.items():
+        if key.endswith("utctime") and isinstance(value, str) and value.endswith("Z"):
+            try:
+                value = int(datetime.fromisoformat(value[:-1]).timestamp())
+            except ValueError:
+                pass
+        converted[key] = epoch_timestamps(value)
+    return converted
+
+# Encodes telemetry for the wire
+class TelemetryEncoder:
+    def __init__(self, format="json", compress_batches=False):
+        if format not in CONTENT_TYPES:
+            raise Exception("Telemetry format must be one of {}".format(", ".join(CONTENT_TYPES)))
+        self.format = format
+        self.compress_batches = compress_batches
+        if format == "msgpack":
+            import msgpack
+            self.msgpack = msgpack
+
+    # return (payload, content type, content encoding). Payload is str for uncompressed json, else bytes.
+    def encode(self, telemetry, batch=False):
+        if self.format == "json":
+            payload = json.dumps(telemetry)
+            encoding = "utf-8"
+        else:
+            telemetry = epoch_timestamps(telemetry)
+            if self.format == "cbor":
+                payload = cbor2.dumps(telemetry) if cbor2 is not None else cbor_encode(telemetry)
+            else:
+                payload = self.msgpack.packb(telemetry, use_bin_type=True)
+            encoding = None
+        if batch and self.compress_batches:
+            if isinstance(payload, str):
+                payload = payload.encode('utf-8')
+            payload = gzip.compress(payload)
+            encoding = "gzip"
+        return payload, CONTENT_TYPES[self.format], encoding
+
+# Compare bytes on the wire and encode time of the formats
+def benchmark_codec(records=50, rounds=200):
+    record = {
+        "tempSetPoint": 21, "tempCurrent": 20.8, "tempAlert": False,
+        "utctime": "2020-05-23T12:00:00.123456Z",
+        "outdoor": {"fetched_utctime": "2020-05-23T11:40:00.654321Z", "temp": 12.35, "wind": 4.1, "age": 1200},
+        "tempSummary": {"count": 240, "min": 20.5, "max": 21.3, "mean": 20.91, "last": 20.8, "p10": 20.6, "p50": 20.9, "p90": 21.2},
+    }
+    formats = ["json", "cbor"]
+    try:
+        import msgpack
+        formats.append("msgpack")
+    except ImportError:
+        pass
+    for format in formats:
+        for compress in (False, True):
+            encoder = TelemetryEncoder(format, compress)
+            batch = [dict(record, tempCurrent=20 + i / 10) for i in range(records)]
+            started = time.perf_counter()
+            for i in range(rounds):
+                single = encoder.encode(record)[0]
+                batched = encoder.encode(batch, batch=True)[0]
+            elapsed = (time.perf_counter() - started) / rounds
+            print("{:8s} gzip={:5s}: single {:4d} bytes, batch of {} {:6d} bytes, {:7.1f} us per single+batch".format(
+                format, str(compress), len(single), records, len(batched), elapsed * 1e6))
+
+if __name__ == '__main__':
+    benchmark_codec()
@@ -0,0 +1,117 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from device_log import fields
+
+TELEMETRY_QUEUE_FILE = 'telemetry_queue.db'
+# Queue of a gateway, its records carry the device id and can not be mixed with single device records
+GATEWAY_QUEUE_FILE = 'telemetry_queue_gateway.db'
+
+# Max records uploaded in one request when draining a backlog
+UPLOAD_BATCH_SIZE = 50
+# Retry delay after a failed upload, doubled for every failure up to max
+UPLOAD_RETRY_MIN = 10
+UPLOAD_RETRY_MAX = 10*60
+
+log = logging.getLogger("telemetry")
+
+# Durable FIFO of telemetry records in an SQLite database (WAL mode).
+# Holds at most max_records, the oldest records are dropped when full.
+class TelemetryQueue:
+    def __init__(self, path=TELEMETRY_QUEUE_FILE, max_records=10000):
+        self.max_records = max_records
+        self.lock = threading.Lock()
+        self.added = threading.Event()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS telemetry (id INTEGER PRIMARY KEY AUTOINCREMENT, record TEXT NOT NULL)")
+        self.count = self.db.execute("SELECT COUNT(*) FROM telemetry").fetchone()[0]
+        self.dropped = 0
+
+    def __len__(self):
+        return self.count
+
+    # Store a record, evicting the oldest ones if the queue is full
+    def put(self, record):
+        with self.lock:
+            with self.db:
+                self.db.execute("BEGIN")
+                self.db.execute("INSERT INTO telemetry (record) VALUES (?)", (json.dumps(record),))
+                self.count += 1
+                if self.count > self.max_records:
+                    self.db.execute("DELETE FROM telemetry WHERE id IN (SELECT id FROM telemetry ORDER BY id LIMIT ?)",
+                                    (self.count - self.max_records,))
+                    self.dropped += self.count - self.max_records
+                    self.count = self.max_records
+        self.added.set()
+
+    # Oldest records, without removing them
+    # return [(id, record)]
+    def peek(self, limit):
+        with self.lock:
+            rows = self.db.execute("SELECT id, record FROM telemetry ORDER BY id LIMIT ?", (limit,)).fetchall()
+        return [(id, json.loads(record)) for id, record in rows]
+
+    # Remove records that have been uploaded
+    def remove(self, ids):
+        with self.lock:
+            with self.db:
+                self.db.execute("BEGIN")
+                deleted = self.db.executemany("DELETE FROM telemetry WHERE id = ?", [(id,) for id in ids]).rowcount
+            self.count -= deleted
+
+    # Wait until a record is added or timeout seconds have passed
+    def wait(self, timeout):
+        self.added.wait(timeout)
+        self.added.clear()
+
+# Thread draining the queue to the cloud hub.
+# A single record goes through hub.post_telemetry, a backlog through hub.post_telemetry_batch.
+# on_uploaded() is called after every successful upload.
+# With a gather_delay records added within that many seconds are uploaded together.
+class TelemetryUploader:
+    def __init__(self, queue, hub, batch_size=UPLOAD_BATCH_SIZE, on_uploaded=None, gather_delay=0):
+        self.queue = queue
+        self.hub = hub
+        self.batch_size = batch_size
+        self.on_uploaded = on_uploaded
+        self.gather_delay = gather_delay
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    # Start the thread, if not started already (the devices of a gateway share the uploader)
+    def start(self):
+        if self.thread.ident is None:
+            self.thread.start()
+
+    def upload(self, records):
+        if len(records) == 1:
+            return self.hub.post_telemetry(records[0])
+        print("Uploading {} queued telemetry records @ {}".format(len(records), datetime.now()))
+        return self.hub.post_telemetry_batch(records)
+
+    def run(self):
+        retry_delay = UPLOAD_RETRY_MIN
+        while True:
+            batch = self.queue.peek(self.batch_size)
+            if len(batch) == 0:
+                self.queue.wait(None)
+                time.sleep(self.gather_delay)
+                continue
+            try:
+                sent = self.upload([record for id, record in batch])
+            except Exception as e:
+                log.error("Telemetry upload raised: {}".format(e))
+                sent = False
+            if sent:
+                self.queue.remove([id for id, record in batch])
+                retry_delay = UPLOAD_RETRY_MIN
+                if self.on_uploaded is not None:
+                    self.on_uploaded()
+            else:
+                log.warning("Telemetry upload failed", extra=fields(queued=len(self.queue), retry=retry_delay))
+                time.sleep(retry_delay)
+                retry_delay = min(2 * retry_delay, UPLOAD_RETRY_MAX)
@@ -0,0 +1,38 @@
+# Decides when to send telemetry in report by exception mode (deadband > 0).
+# Telemetry is sent when the filtered temp has moved more than the deadband
+# since the last report, when the setpoint or AC status has changed, or at
+# the latest when the heartbeat interval has passed.
+class TelemetryReporter:
+    def __init__(self):
+        self.deadband = 0
+        self.heartbeat = 60*60
+        self.last_reported = None    # (temp, setpoint, ac status)
+
+    def configure(self, deadband, heartbeat):
+        self.deadband = deadband
+        self.heartbeat = heartbeat
+
+    def enabled(self):
+        return self.deadband > 0
+
+    # Max time between two telemetry reports
+    def get_interval(self, telemetry_interval):
+        if self.enabled():
+            return self.heartbeat
+        return telemetry_interval
+
+    # return reason to report now, or None
+    def get_change(self, temp, setpoint, ac_status):
+        if not self.enabled() or self.last_reported is None:
+            return None
+        last_temp, last_setpoint, last_ac_status = self.last_reported
+        if abs(temp - last_temp) >= self.deadband:
+            return "temp changed from {} to {}".format(last_temp, temp)
+        if setpoint != last_setpoint:
+            return "setpoint changed from {} to {}".format(last_setpoint, setpoint)
+        if ac_status != last_ac_status:
+            return "AC status changed"
+        return None
+
+    def reported(self, temp, setpoint, ac_status):
+        self.last_reported = (temp, setpoint, ac_status)
@@ -1,90 +1,393 @@
 import os
+import sys
 import glob
+import logging
 import time
 import random
+import threading
 import platform
+from bisect import bisect_left, insort
 from datetime import datetime
 from device_config import DeviceConfig
+from sample_aggregator import SampleAggregator
+from sample_store import SampleStore
+
+log = logging.getLogger("temp")
+
+# Index of the reported value among the sorted samples (4th lowest)
+FILTER_ORDER_STATISTIC = 3
+
+# Fixed size window of samples with the k:th lowest value available at any time.
+# Samples are kept in a ring buffer (age order) and in a sorted list (value order).
+# Insert/evict locate their position by bisection and the k:th lowest is a plain index,
+# so no sorting or list copying is done per sample.
+class OrderStatisticFilter:
+
+    def __init__(self, capacity, initial=None):
+        self.capacity = max(1, capacity)
+        self.ring = [0.0] * self.capacity
+        self.head = 0   # Index of oldest sample in ring
+        self.count = 0
+        self.sorted = []
+        if initial is not None:
+            for value in initial:
+                self.append(value)
+
+    def __len__(self):
+        return self.count
+
+    # Add a sample, evicting the oldest one if the window is full
+    def append(self, value):
+        if self.count == self.capacity:
+            oldest = self.ring[self.head]
+            del self.sorted[bisect_left(self.sorted, oldest)]
+            self.ring[self.head] = value
+            self.head = (self.head + 1) % self.capacity
+        else:
+            self.ring[(self.head + self.count) % self.capacity] = value
+            self.count += 1
+        insort(self.sorted, value)
+
+    # Most recently added sample
+    def last(self):
+        return self.ring[(self.head + self.count - 1) % self.capacity]
+
+    # Samples in age order, oldest first
+    def values(self):
+        return [self.ring[(self.head + i) % self.capacity] for i in range(self.count)]
+
+    # k:th lowest sample (0 = min). Falls back to min while fewer than k+1 samples.
+    def kth_lowest(self, k):
+        if self.count > k:
+            return self.sorted[k]
+        return self.sorted[0]
+
+    # Change window size. When shrinking, the oldest samples are kept.
+    def resize(self, capacity):
+        kept = self.values()[:max(1, capacity)]
+        self.__init__(capacity, kept)
+
+# Where the w1-therm driver exposes the sensors
+W1_BASE_DIR = '/sys/bus/w1/devices/'
+
+# Conversion time in seconds for each DS18B20 resolution in bits
+CONVERSION_TIME = { 9: 0.094, 10: 0.188, 11: 0.375, 12: 0.75 }
+
+# Sampler thread reports the reading as stale after this many missed sampling periods
+SAMPLER_STALE_PERIODS = 3
+
+# Sensor id of simulated readings in the sample store
+SIMULATED_SENSOR = 'simulated'
+
+# Readers sharing a bus (the devices of a gateway) share its bulk conversions:
+# therm_bulk_read file -> (time of conversion, sensors with an unread result).
+# A reader whose sensors all have a fresh unread result skips the conversion.
+bulk_results = {}
+bulk_lock = threading.Lock()
 
 # Read a DS1820 temp sensor
 class Temperature:
 
-    def __init__(self, device_config):
-        self.temp_readings = [21]
+    # ac_state: optional function returning (setpoint, AC active), stored with every sample
+    def __init__(self, device_config, base_dir=W1_BASE_DIR, ac_state=None):
         self.AVERAGE_INTERVAL = 120 #device_config.temp_average
+        self.temp_readings = OrderStatisticFilter(self.AVERAGE_INTERVAL, [21])
         self.temp_sampling = device_config.temp_sampling
+        self.lock = threading.Lock()
+        self.sampler = None
+        self.latest = (21, 21)
+        self.latest_read_at = time.monotonic()
+        self.sensor_temps = {}
+        self.device_files = {}
+        self.bulk_read_file = None
+        self.resolution = device_config.temp_resolution
+        self.aggregator = SampleAggregator(device_config.temp_percentiles)
+        self.aggregated_until = None
+        self.ac_state = ac_state
+        self.store = None
         if device_config.is_simulated:
             self.hardware = False
         else:
             self.hardware = True
-            os.system('modprobe w1-gpio')
-            os.system('modprobe w1-therm')
-            try:
-                base_dir = '/sys/bus/w1/devices/'
-                device_folder = glob.glob(base_dir + '28*')[0]
-                self.device_file = device_folder + '/w1_slave'
-            except:
+            if base_dir == W1_BASE_DIR:
+                os.system('modprobe w1-gpio')
+                os.system('modprobe w1-therm')
+            self.bus_sensors = set()
+            for device_folder in sorted(glob.glob(os.path.join(base_dir, '28*'))):
+                self.bus_sensors.add(os.path.basename(device_folder))
+                if device_config.temp_sensor in (None, os.path.basename(device_folder)):
+                    self.device_files[os.path.basename(device_folder)] = device_folder + '/w1_slave'
+            if len(self.device_files) > 0:
+                # First sensor feeds the filter
+                self.device_file = next(iter(self.device_files.values()))
+                bulk_read_files = glob.glob(os.path.join(base_dir, 'w1_bus_master*', 'therm_bulk_read'))
+                if len(bulk_read_files) > 0:
+                    self.bulk_read_file = bulk_read_files[0]
+                if self.resolution is not None:
+                    self.set_resolution(self.resolution)
+                print("Found temp sensors: {}".format(", ".join(self.device_files)))
+            else:
                 self.hardware = False
                 print("No temp sensor found. Simulating temp readings")
+        if device_config.sample_store_days > 0:
+            self.open_store(device_config.sample_store_days, device_config.sample_store_file)
+        if device_config.temp_sampler:
+            self.start_sampler()
+
+    # Id of the sensor feeding the filter
+    def get_sensor_id(self):
+        if self.hardware:
+            return next(iter(self.device_files))
+        return SIMULATED_SENSOR
+
+    # Keep all samples for days in the sample store. Samples stored before a reboot
+    # warm up the filter and are added to the summary if not yet reported.
+    def open_store(self, days, path):
+        sensors = max(1, len(self.device_files))
+        try:
+            self.store = SampleStore(int(days * 24*60*60 / self.temp_sampling) * sensors, path)
+        except Exception as e:
+            log.error("Could not open sample store: {}".format(e))
+            return
+        now = time.time()
+        values = [sample.value for sample in self.store.query(now - self.AVERAGE_INTERVAL * self.temp_sampling, now, self.get_sensor_id())]
+        if len(values) > 0:
+            self.temp_readings = OrderStatisticFilter(self.AVERAGE_INTERVAL, values[-self.AVERAGE_INTERVAL:])
+            self.latest = (round(values[-1], 1), round(self.temp_readings.kth_lowest(FILTER_ORDER_STATISTIC), 1))
+            print("Temp filter warmed up with {} stored samples".format(len(self.temp_readings)))
+        reported_until = self.store.reported_until()
+        if reported_until > 0:
+            for sample in self.store.query(reported_until, now, self.get_sensor_id()):
+                if sample.time > reported_until:
+                    self.aggregator.add(sample.value)
+                    self.aggregated_until = sample.time
+
+    # Append the valid readings to the sample store
+    def store_samples(self, temps):
+        if self.store is None:
+            return
+        try:
+            setpoint, ac_active = self.ac_state() if self.ac_state is not None else (None, False)
+            now = time.time()
+            for sensor, temp in temps.items():
+                if temp is not None:
+                    self.store.append(now, sensor, temp, setpoint, ac_active)
+        except Exception as e:
+            log.error("Could not store samples: {}".format(e))
 
     def set_filter_time(self, filter_time):
         try:
             self.AVERAGE_INTERVAL = int(filter_time / self.temp_sampling)
         except Exception as e:
-            print(e)
+            log.warning("Invalid filter time {}: {}".format(filter_time, e))
             self.AVERAGE_INTERVAL = 120
-        if len(self.temp_readings) > self.AVERAGE_INTERVAL:
-            del self.temp_readings[self.AVERAGE_INTERVAL:]
-            
+        with self.lock:
+            self.temp_readings.resize(self.AVERAGE_INTERVAL)
+
+    # Set conversion resolution (9-12 bits) of all sensors
+    def set_resolution(self, bits):
+        bits = max(min(bits, max(CONVERSION_TIME)), min(CONVERSION_TIME))
+        for sensor, device_file in self.device_files.items():
+            try:
+                with open(os.path.join(os.path.dirname(device_file), 'resolution'), 'w') as f:
+                    f.write(str(bits))
+            except Exception as e:
+                log.error("Could not set resolution of sensor {}: {}".format(sensor, e))
+        self.resolution = bits
+
     # Read DS1820 output
-    def read_temp_raw(self):
+    def read_temp_raw(self, device_file=None):
+        if device_file is None:
+            device_file = self.device_file
         lines = ""
-        with open(self.device_file, 'r') as f:
+        with open(device_file, 'r') as f:
             lines = f.readlines()
         return lines
-        
-    # Read temp and calculate a rolling average over AVERAGE_INTERVAL samples
-    # return (currentTemp, averageTemp)
-    def get(self):
-        if self.hardware:
-            lines = self.read_temp_raw()
-
-            i = 50
-            while lines[0].strip()[-3:] != 'YES':
-                time.sleep(0.2)
-                lines = self.read_temp_raw()
-                i -= 1
-                if i == 0:
-                    break
-
-            if i > 0:
-                equals_pos = lines[1].find('t=')
-                if equals_pos != -1:
-                    temp_string = lines[1][equals_pos+2:]
-                    temp_c = float(temp_string) / 1000.0
-            else:
-                print("Could not read temperature @ {}".format(datetime.now()))
-                temp_c = self.temp_readings[-1]
 
-        else:
+    # Start a temperature conversion on all sensors at once and wait for it to finish
+    # return True if the conversion completed
+    def bulk_convert(self):
+        with open(self.bulk_read_file, 'w') as f:
+            f.write('trigger')
+        conversion_time = CONVERSION_TIME.get(self.resolution, CONVERSION_TIME[12])
+        deadline = time.monotonic() + 2 * conversion_time
+        time.sleep(conversion_time)
+        while True:
+            with open(self.bulk_read_file, 'r') as f:
+                status = f.read().strip()
+            # -1 while any sensor is still converting
+            if status != '-1':
+                return True
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+
+    # Read one sensor, retrying while the CRC check fails
+    # return temp in degC or None if no valid reading
+    def read_w1_slave(self, device_file):
+        lines = self.read_temp_raw(device_file)
+
+        i = 50
+        while lines[0].strip()[-3:] != 'YES':
+            time.sleep(0.2)
+            lines = self.read_temp_raw(device_file)
+            i -= 1
+            if i == 0:
+                break
+
+        if i > 0:
+            equals_pos = lines[1].find('t=')
+            if equals_pos != -1:
+                temp_string = lines[1][equals_pos+2:]
+                return float(temp_string) / 1000.0
+        return None
+
+    # Read all sensors. With a bulk read trigger all sensors convert in parallel and
+    # the following reads return the converted values directly.
+    # return {sensor id: temp in degC or None}
+    def read_sensors(self):
+        if self.bulk_read_file is not None:
+            with bulk_lock:
+                converted_at, unread = bulk_results.get(self.bulk_read_file, (0, set()))
+                if time.monotonic() - converted_at < self.temp_sampling and set(self.device_files) <= unread:
+                    # Converted for another reader on the bus this period
+                    unread -= set(self.device_files)
+                else:
+                    try:
+                        if not self.bulk_convert():
+                            log.warning("Bulk temperature conversion timed out @ {}".format(datetime.now()))
+                    except Exception as e:
+                        log.error("Bulk temperature conversion failed: {}".format(e))
+                    bulk_results[self.bulk_read_file] = (time.monotonic(), self.bus_sensors - set(self.device_files))
+        temps = {}
+        for sensor, device_file in self.device_files.items():
+            try:
+                temps[sensor] = self.read_w1_slave(device_file)
+            except Exception as e:
+                log.error("Could not read sensor {}: {}".format(sensor, e))
+                temps[sensor] = None
+        return temps
+
+    # Read the sensors
+    # return temp in degC of the first sensor or None if no valid reading
+    def read_sensor(self):
+        if not self.hardware:
             # Simulating a temp around 21 deg C
-            temp_c = 21 + (random.random() * 3) - 1.5
+            temp = 21 + (random.random() * 3) - 1.5
+            self.store_samples({SIMULATED_SENSOR: temp})
+            return temp
+
+        temps = self.read_sensors()
+        self.store_samples(temps)
+        with self.lock:
+            self.sensor_temps = {sensor: round(temp, 1) for sensor, temp in temps.items() if temp is not None}
+        return temps[next(iter(temps))]
+
+    # Read the sensor once and feed the filter
+    # return (currentTemp, filteredTemp)
+    def sample(self):
+        try:
+            temp_c = self.read_sensor()
+        except Exception as e:
+            log.error("Could not read temperature: {}".format(e))
+            temp_c = None
+
+        with self.lock:
+            if temp_c is None:
+                log.warning("Could not read temperature @ {}, using the last reading".format(datetime.now()))
+                temp_c = self.temp_readings.last()
+            else:
+                self.latest_read_at = time.monotonic()
+                self.aggregator.add(temp_c)
+                self.aggregated_until = time.time()
+
+            self.temp_readings.append(temp_c)
+            temp_m = self.temp_readings.kth_lowest(FILTER_ORDER_STATISTIC)
+
+            self.latest = (round(temp_c, 1), round(temp_m, 1))
+            return self.latest
+
+    # Read temp and calculate a rolling filter over AVERAGE_INTERVAL samples
+    # With the sampler thread running the latest values are returned without touching the sensor
+    # return (currentTemp, filteredTemp)
+    def get(self):
+        if self.sampler is not None:
+            with self.lock:
+                return self.latest
+        return self.sample()
+
+    # Summary (min, max, mean, last, count, percentiles) of the valid readings since the last call,
+    # or None if there were none
+    def take_summary(self):
+        with self.lock:
+            if self.store is not None and self.aggregated_until is not None:
+                # Stored samples up to here need no backfill after a reboot
+                self.store.mark_reported(self.aggregated_until)
+            return self.aggregator.take_summary()
+
+    # Latest valid reading of each sensor
+    # return {sensor id: temp in degC}
+    def get_sensors(self):
+        with self.lock:
+            return dict(self.sensor_temps)
+
+    # Seconds since the sensor last gave a valid reading
+    def get_age(self):
+        with self.lock:
+            return time.monotonic() - self.latest_read_at
+
+    # True if the sampler thread has not got a valid reading for a while
+    def is_stale(self):
+        if self.sampler is None:
+            return False
+        return self.get_age() > SAMPLER_STALE_PERIODS * self.temp_sampling
+
+    # Sample the sensor every temp_sampling seconds in a background thread
+    def start_sampler(self):
+        if self.sampler is None:
+            self.sample()
+            self.sampler = threading.Thread(target=self.sampler_loop, daemon=True)
+            self.sampler.start()
+
+    def sampler_loop(self):
+        next_sample_at = time.monotonic()
+        while True:
+            next_sample_at += self.temp_sampling
+            time.sleep(max(0, next_sample_at - time.monotonic()))
+            self.sample()
+            # Do not try to catch up after a slow read
+            next_sample_at = max(next_sample_at, time.monotonic() - self.temp_sampling)
+
+# Compare the filter against sorting the whole window for every sample
+def benchmark_filter(window_sizes=(10, 120, 360, 720), samples=20000):
+    for window in window_sizes:
+        values = [21 + (random.random() * 3) - 1.5 for i in range(samples)]
 
-        self.temp_readings.append(temp_c)
-        if len(self.temp_readings) > self.AVERAGE_INTERVAL:
-            self.temp_readings = self.temp_readings[1:]
+        readings = [21]
+        started = time.perf_counter()
+        for value in values:
+            readings.append(value)
+            if len(readings) > window:
+                readings = readings[1:]
+            readings_sorted = sorted(readings)
+            reference = readings_sorted[3] if len(readings_sorted) > 3 else readings_sorted[0]
+        sort_time = time.perf_counter() - started
 
-        temp_readings_sorted = sorted(self.temp_readings)
-        temp_m = temp_readings_sorted[0]
-        if len(temp_readings_sorted) > 3:
-            temp_m = temp_readings_sorted[3]
-        
-        temp_c = round(temp_c, 1)
-        temp_m = round(temp_m, 1)
+        readings = OrderStatisticFilter(window, [21])
+        started = time.perf_counter()
+        for value in values:
+            readings.append(value)
+            result = readings.kth_lowest(FILTER_ORDER_STATISTIC)
+        filter_time = time.perf_counter() - started
 
-        return temp_c, temp_m
+        assert result == reference
+        print("window {:4d}: sort {:7.2f} us/sample, filter {:5.2f} us/sample ({:.1f}x)".format(
+            window, sort_time / samples * 1e6, filter_time / samples * 1e6, sort_time / filter_time))
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark_filter()
+        sys.exit()
     device_config = DeviceConfig()
     reader = Temperature(device_config)
     for i in range(100):
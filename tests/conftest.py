@@ -0,0 +1,63 @@
+import os
+import shutil
+import socket
+import sys
+import threading
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# Runs in a temp directory with a copy of lg_ac.conf, so no runtime files end up in the repo
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    shutil.copy(os.path.join(REPO_DIR, 'lg_ac.conf'), str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+# Fake lircd on a Unix socket. reply(command) returns the lines between BEGIN/<command> and END,
+# default SUCCESS. The commands received are kept in received.
+class FakeLircd:
+    def __init__(self, path):
+        self.path = path
+        self.received = []
+        self.reply = lambda command: ["SUCCESS"]
+        # Packet lines sent before the next reply, e.g. a SIGHUP broadcast
+        self.broadcast = []
+        # Connections are closed after this many commands, None keeps them open
+        self.commands_per_connection = None
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                conn, address = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+        with conn, conn.makefile('rb') as f:
+            count = 0
+            for line in f:
+                command = line.decode('ascii').strip()
+                self.received.append(command)
+                lines = self.broadcast + ["BEGIN", command] + self.reply(command) + ["END"]
+                self.broadcast = []
+                conn.sendall(("\n".join(lines) + "\n").encode('ascii'))
+                count += 1
+                if count == self.commands_per_connection:
+                    return
+
+    def close(self):
+        self.sock.close()
+
+@pytest.fixture
+def lircd(tmp_path):
+    server = FakeLircd(str(tmp_path / 'lircd'))
+    yield server
+    server.close()
@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+
+import air_condition
+from air_condition import AirCondition
+
+def make_ac(lircd):
+    return AirCondition(SimpleNamespace(is_simulated=False, lirc_socket=lircd.path, ir_remote="LG_AC"))
+
+def test_setpoint_sent(workdir, lircd):
+    ac = make_ac(lircd)
+    ac.set_temp(22)
+    assert ac.wait_idle(5)
+    assert lircd.received == ["SEND_ONCE LG_AC AC_ON", "SEND_ONCE LG_AC HEAT_HIGH_22"]
+    assert ac.sent_temp == 22
+    assert ac.last_sent_code == "HEAT_HIGH_22"
+
+def test_failed_setpoint_is_retried(workdir, lircd, monkeypatch):
+    monkeypatch.setattr(air_condition, "IR_RETRY_MIN", 0.1)
+    failures = [2]
+    def reply(command):
+        if command.endswith("HEAT_HIGH_22") and failures[0] > 0:
+            failures[0] -= 1
+            return ["ERROR", "DATA", "1", "transmission failed"]
+        return ["SUCCESS"]
+    lircd.reply = reply
+    ac = make_ac(lircd)
+    ac.set_temp(22)
+    assert ac.wait_idle(5)
+    assert lircd.received.count("SEND_ONCE LG_AC HEAT_HIGH_22") == 3
+    assert ac.sent_temp == 22
+    assert ac.last_sent_code == "HEAT_HIGH_22"
+
+def test_failed_code_not_reported_as_sent(workdir, lircd):
+    lircd.reply = lambda command: ["ERROR", "DATA", "1", "transmission failed"]
+    ac = make_ac(lircd)
+    ac.set_temp(22)
+    assert not ac.wait_idle(0.5)
+    assert ac.sent_temp is None
+    assert ac.last_sent_code is None
@@ -0,0 +1,114 @@
+import json
+from contextlib import contextmanager
+
+from firebase_stream import FirebaseStream
+
+# Recorded event stream of a device_twin/desired node, ending with the token expiring
+RECORDED_EVENTS = [
+    ("put",   {"path": "/", "data": {"tempSetPoint": 21, "telemetryInterval": 1200, "fallbackDate": "2025-01-01"}}),
+    ("keep-alive", None),
+    ("patch", {"path": "/", "data": {"tempSetPoint": 22, "updateTime": "2025-03-01T10:00:00.000Z"}}),
+    ("put",   {"path": "/fallbackDate", "data": None}),
+    ("put",   {"path": "/schedule/morning", "data": 19}),
+    ("auth_revoked", "credential is no longer valid"),
+    ("put",   {"path": "/tempSetPoint", "data": 30}),
+]
+
+def sse_lines(events):
+    for event, data in events:
+        yield "event: {}".format(event)
+        yield "data: {}".format(json.dumps(data))
+        yield ""
+
+class FakeResponse:
+    def __init__(self, lines):
+        self.lines = lines
+        self.encoding = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self, chunk_size=1, decode_unicode=False):
+        return iter(self.lines)
+
+class FakeFirebase:
+    def __init__(self, events):
+        self.config = {"db_config": {"databaseURL": "https://example.firebaseio.com"}}
+        self.refreshed = 0
+        self.requests = []
+        firebase = self
+
+        class Session:
+            def get(self, url, params=None, headers=None, stream=False):
+                firebase.requests.append((url, params, headers))
+                return FakeResponse(list(sse_lines(events)))
+
+        class FirebaseSession:
+            session = Session()
+
+            @contextmanager
+            def operation(self, name):
+                yield
+
+        class Credentials:
+            def refresh(self):
+                firebase.refreshed += 1
+
+        self.session = FirebaseSession()
+        self.credentials = Credentials()
+
+    def get_user(self):
+        return {"idToken": "token", "localId": "uid"}
+
+def test_put_patch_and_auth_revoked():
+    firebase = FakeFirebase(RECORDED_EVENTS)
+    changes = []
+    stream = FirebaseStream(firebase, lambda: "users/uid/dev/device_twin/desired", changes.append)
+
+    assert stream.listen()
+
+    url, params, headers = firebase.requests[0]
+    assert url == "https://example.firebaseio.com/users/uid/dev/device_twin/desired.json"
+    assert params == {"auth": "token"}
+    assert headers["Accept"] == "text/event-stream"
+    assert stream.connected
+    # Put, patch and the two child puts change the node, keep-alive does not
+    assert len(changes) == 4
+    assert changes[0] == {"tempSetPoint": 21, "telemetryInterval": 1200, "fallbackDate": "2025-01-01"}
+    assert changes[1]["tempSetPoint"] == 22
+    assert changes[1]["updateTime"] == "2025-03-01T10:00:00.000Z"
+    assert "fallbackDate" not in changes[2]
+    assert changes[3] == {"tempSetPoint": 22, "telemetryInterval": 1200,
+                          "updateTime": "2025-03-01T10:00:00.000Z", "schedule": {"morning": 19}}
+    # auth_revoked refreshes the token and closes the stream, later events are not applied
+    assert firebase.refreshed == 1
+    assert stream.node["tempSetPoint"] == 22
+
+def test_changes_are_copies():
+    firebase = FakeFirebase(RECORDED_EVENTS[:1])
+    changes = []
+    stream = FirebaseStream(firebase, lambda: "desired", changes.append)
+    stream.listen()
+    changes[0]["tempSetPoint"] = 5
+    assert stream.node["tempSetPoint"] == 21
+
+def test_leaf_node():
+    firebase = FakeFirebase([("put", {"path": "/", "data": True}), ("put", {"path": "/", "data": False})])
+    changes = []
+    stream = FirebaseStream(firebase, lambda: "users/uid/dev/reboot", changes.append)
+    stream.listen()
+    assert changes == [True, False]
+
+def test_cancel_closes_stream():
+    firebase = FakeFirebase([("cancel", "permission denied"), ("put", {"path": "/", "data": 1})])
+    changes = []
+    stream = FirebaseStream(firebase, lambda: "desired", changes.append)
+    assert stream.listen()
+    assert changes == []
+    assert firebase.refreshed == 0
@@ -0,0 +1,39 @@
+import pytest
+
+from lirc_client import LircClient, LircError
+
+def test_send_once_success(lircd):
+    client = LircClient(lircd.path)
+    client.send_once("LG_AC", "HEAT_HIGH_22")
+    client.send_once("LG_AC", "AC_OFF")
+    assert lircd.received == ["SEND_ONCE LG_AC HEAT_HIGH_22", "SEND_ONCE LG_AC AC_OFF"]
+
+def test_error_raises_with_message(lircd):
+    lircd.reply = lambda command: ["ERROR", "DATA", "1", 'unknown command: "HEAT_HIGH_99"']
+    client = LircClient(lircd.path)
+    with pytest.raises(LircError) as e:
+        client.send_once("LG_AC", "HEAT_HIGH_99")
+    assert "unknown command" in str(e.value)
+
+def test_data_lines_returned(lircd):
+    lircd.reply = lambda command: ["SUCCESS", "DATA", "3", "LG_AC", "TV", "FAN"]
+    client = LircClient(lircd.path)
+    assert client.command("LIST") == ["LG_AC", "TV", "FAN"]
+
+def test_broadcast_before_reply_is_skipped(lircd):
+    lircd.broadcast = ["BEGIN", "SIGHUP", "END"]
+    client = LircClient(lircd.path)
+    client.send_once("LG_AC", "AC_ON")
+    assert lircd.received == ["SEND_ONCE LG_AC AC_ON"]
+
+def test_reconnects_after_lost_connection(lircd):
+    lircd.commands_per_connection = 1
+    client = LircClient(lircd.path)
+    client.send_once("LG_AC", "AC_ON")
+    client.send_once("LG_AC", "AC_OFF")
+    assert lircd.received == ["SEND_ONCE LG_AC AC_ON", "SEND_ONCE LG_AC AC_OFF"]
+
+def test_no_lircd(tmp_path):
+    client = LircClient(str(tmp_path / 'missing'), timeout=1)
+    with pytest.raises(LircError):
+        client.send_once("LG_AC", "AC_ON")
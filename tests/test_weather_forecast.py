@@ -0,0 +1,77 @@
+import json
+import os
+import time
+
+import pytest
+
+import weather
+from weather import Weather, WeatherForecast
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'forecast.json')
+# Times of the five 3-hourly points in the recorded response
+T0 = 1590224400
+STEP = 3*60*60
+
+@pytest.fixture
+def response():
+    with open(FIXTURE) as f:
+        return json.load(f)
+
+def test_points_are_sorted(response):
+    forecast = WeatherForecast.from_response(response)
+    assert list(forecast.times) == [T0 + i * STEP for i in range(5)]
+    assert list(forecast.temps) == [11.2, 14.6, 16.1, 13.4, 9.8]
+    assert forecast.end() == T0 + 4 * STEP
+
+def test_interpolation(response):
+    forecast = WeatherForecast.from_response(response)
+    assert forecast.get(T0) == (11.2, 3.1)
+    assert forecast.get(T0 + STEP) == (14.6, 4.6)
+    temp, wind = forecast.get(T0 + STEP + STEP / 3)
+    assert temp == pytest.approx(14.6 + (16.1 - 14.6) / 3)
+    assert wind == pytest.approx(4.6 + (5.2 - 4.6) / 3)
+    temp, wind = forecast.get(T0 + 2.5 * STEP)
+    assert temp == pytest.approx((16.1 + 13.4) / 2)
+    assert wind == pytest.approx((5.2 + 2.4) / 2)
+
+def test_clamped_outside_forecast(response):
+    forecast = WeatherForecast.from_response(response)
+    assert forecast.get(T0 - 3600) == (11.2, 3.1)
+    assert forecast.get(T0 + 4 * STEP) == (9.8, 1.1)
+    assert forecast.get(T0 + 10 * STEP) == (9.8, 1.1)
+
+def test_round_trip_through_cache(response):
+    forecast = WeatherForecast.from_response(response)
+    restored = WeatherForecast.from_dict(json.loads(json.dumps(forecast.to_dict())))
+    assert restored.get(T0 + 1.5 * STEP) == forecast.get(T0 + 1.5 * STEP)
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+def test_weather_get_interpolates_fetched_forecast(workdir, response, monkeypatch):
+    with open('weather.json', 'w') as f:
+        json.dump({"appid": "id", "long": "12.57", "lat": "55.67", "forecast": True}, f)
+    requests_made = []
+    def get(url, timeout=None):
+        requests_made.append(url)
+        return FakeResponse(response)
+    monkeypatch.setattr(weather.requests, "get", get)
+
+    w = Weather()
+    w.get(T0)
+    w.fetcher.join(5)
+    assert "/forecast?" in requests_made[0]
+
+    current = w.get(T0 + 2.5 * STEP)
+    assert current["temp"] == round((16.1 + 13.4) / 2, 2)
+    assert current["wind"] == round((5.2 + 2.4) / 2, 2)
+    assert current["age"] <= 1
+    assert w.get(T0 - STEP)["temp"] == 11.2
+    # The forecast is cached for the next start
+    assert Weather().get(T0 + STEP)["temp"] == 14.6
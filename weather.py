@@ -1,48 +1,173 @@
+import os
 import time
+import threading
 import requests
 import json
+import logging
+from array import array
+from bisect import bisect_right
 from common import Common
 
+log = logging.getLogger("weather")
+
+# Last good weather, read at boot so telemetry has outdoor data before the first fetch
+WEATHER_CACHE_FILE = 'weather_cache.json'
+# (connect, read) timeout for the openweathermap request
+WEATHER_TIMEOUT = (5, 10)
+# Retry delay after a failed fetch, doubled for every failure up to WEATHER_UPDATE_INTERVAL
+WEATHER_RETRY_MIN = 60
+# In forecast mode the 5 day / 3 hour forecast is fetched this often
+FORECAST_UPDATE_INTERVAL = 12*60*60
+
+# 3-hourly forecast stored as time-indexed arrays, interpolated to any time
+class WeatherForecast:
+    def __init__(self, times, temps, winds):
+        self.times = array('d', times)   # Epoch seconds, ascending
+        self.temps = array('d', temps)
+        self.winds = array('d', winds)
+
+    # Parse the response of the openweathermap forecast API
+    @classmethod
+    def from_response(cls, response):
+        entries = sorted(response["list"], key=lambda entry: entry["dt"])
+        return cls([entry["dt"] for entry in entries],
+                   [entry["main"]["temp"] for entry in entries],
+                   [entry["wind"]["speed"] for entry in entries])
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["times"], d["temps"], d["winds"])
+
+    def to_dict(self):
+        return {"times": list(self.times), "temps": list(self.temps), "winds": list(self.winds)}
+
+    # Last time covered by the forecast
+    def end(self):
+        return self.times[-1]
+
+    # Linear interpolation between the forecast points around t, clamped to the first/last point
+    # return (temp, wind)
+    def get(self, t):
+        i = bisect_right(self.times, t)
+        if i == 0:
+            return self.temps[0], self.winds[0]
+        if i == len(self.times):
+            return self.temps[-1], self.winds[-1]
+        f = (t - self.times[i - 1]) / (self.times[i] - self.times[i - 1])
+        return (self.temps[i - 1] + f * (self.temps[i] - self.temps[i - 1]),
+                self.winds[i - 1] + f * (self.winds[i] - self.winds[i - 1]))
+
 class Weather:
 
-    def __init__(self):
+    def __init__(self, cache_file=WEATHER_CACHE_FILE):
         with open('weather.json') as f:
             self.config = json.load(f)
 
+        # Forecast mode fetches a forecast twice a day instead of the current weather every hour
+        self.use_forecast = self.config.get("forecast", False)
         self.WEATHER_UPDATE_INTERVAL = 60*60
-        self.last_fetched_at = -10000
+        if self.use_forecast:
+            self.WEATHER_UPDATE_INTERVAL = FORECAST_UPDATE_INTERVAL
+        self.last_fetched_at = time.monotonic() - self.WEATHER_UPDATE_INTERVAL - 1
+        self.retry_delay = 0
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.fetcher = None
 
-        self.current = {}
-        self.current["fetched_utctime"] = Common.getCurrentUTCTime()
-        self.current["temp"]            = 0
-        self.current["wind"]            = 0
+        self.current = None
+        self.forecast = None
+        self.fetched_at = None   # Epoch time of self.current/self.forecast
+        self.load_cache()
 
-        self.weather_request = "http://api.openweathermap.org/data/2.5/weather?lat={}&lon={}&units=metric&APPID={}".format(
+        api = "forecast" if self.use_forecast else "weather"
+        self.weather_request = "http://api.openweathermap.org/data/2.5/{}?lat={}&lon={}&units=metric&APPID={}".format(
+            api,
             self.config["lat"], 
             self.config["long"], 
             self.config["appid"])
-        
-    # Fetch weather from openweathermap, if more than WEATHER_UPDATE_INTERVAL since last fetch
-    def get(self):
-        elapsed = time.monotonic() - self.last_fetched_at
-        if elapsed > self.WEATHER_UPDATE_INTERVAL:
-            self.last_fetched_at = time.monotonic()
-            try:
-                r = requests.get(self.weather_request)
-                if r.status_code == 200:
-                    weather = r.json()
-                    self.current = {}
-                    self.current["fetched_utctime"] = Common.getCurrentUTCTime() 
-                    self.current["temp"]            = weather["main"]["temp"]
-                    self.current["wind"]            = weather["wind"]["speed"]
-                    print("Weather fetched from openweather at {}".format(self.current["fetched_utctime"]))
+
+    def load_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+            if self.use_forecast:
+                self.forecast = WeatherForecast.from_dict(cache["forecast"])
+                self.current = {"fetched_utctime": cache["fetched_utctime"]}
+            else:
+                self.current = cache["current"]
+            self.fetched_at = cache["fetched_at"]
+            # Fetch again when the cached value is WEATHER_UPDATE_INTERVAL old
+            self.last_fetched_at = time.monotonic() - (time.time() - self.fetched_at)
+        except Exception as e:
+            log.warning("No saved weather: " + str(e))
+
+    def save_cache(self):
+        try:
+            with open(self.cache_file + '.tmp', 'w') as f:
+                if self.use_forecast:
+                    json.dump({"forecast": self.forecast.to_dict(), "fetched_utctime": self.current["fetched_utctime"],
+                               "fetched_at": self.fetched_at}, f)
                 else:
-                    print("openweathermap API returned ERROR code {}".format(r.status_code))
-            except Exception as e:
-                print("openweathermap API throw an execption")
-                print(e)
-                
-        return self.current
+                    json.dump({"current": self.current, "fetched_at": self.fetched_at}, f)
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+        except Exception as e:
+            log.warning("Could not save weather: " + str(e))
+
+    def fetch(self):
+        try:
+            r = requests.get(self.weather_request, timeout=WEATHER_TIMEOUT)
+            if r.status_code == 200:
+                weather = r.json()
+                current = {}
+                current["fetched_utctime"] = Common.getCurrentUTCTime() 
+                forecast = None
+                if self.use_forecast:
+                    forecast = WeatherForecast.from_response(weather)
+                else:
+                    current["temp"]            = weather["main"]["temp"]
+                    current["wind"]            = weather["wind"]["speed"]
+                with self.lock:
+                    self.current = current
+                    self.forecast = forecast
+                    self.fetched_at = time.time()
+                    self.retry_delay = 0
+                    self.save_cache()
+                log.info("Weather fetched from openweather at {}".format(current["fetched_utctime"]))
+                return
+            else:
+                log.error("openweathermap API returned ERROR code {}".format(r.status_code))
+        except Exception as e:
+            log.error("openweathermap API throw an exception: {}".format(e))
+        with self.lock:
+            # Try again after retry_delay instead of a full WEATHER_UPDATE_INTERVAL
+            self.retry_delay = min(max(WEATHER_RETRY_MIN, 2 * self.retry_delay), self.WEATHER_UPDATE_INTERVAL)
+            self.last_fetched_at = time.monotonic() - self.WEATHER_UPDATE_INTERVAL + self.retry_delay
+
+    # Return the last fetched weather at once, tagged with its age in seconds (None if never fetched).
+    # In forecast mode temp and wind are interpolated for timestamp (epoch seconds, default now).
+    # Starts a fetch from openweathermap in the background if more than WEATHER_UPDATE_INTERVAL since last fetch.
+    def get(self, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            elapsed = time.monotonic() - self.last_fetched_at
+            if self.forecast is not None and self.forecast.end() < timestamp and elapsed > WEATHER_RETRY_MIN:
+                # Forecast ran out
+                elapsed = self.WEATHER_UPDATE_INTERVAL + 1
+            if elapsed > self.WEATHER_UPDATE_INTERVAL and (self.fetcher is None or not self.fetcher.is_alive()):
+                self.last_fetched_at = time.monotonic()
+                self.fetcher = threading.Thread(target=self.fetch, daemon=True)
+                self.fetcher.start()
+
+            if self.current is None:
+                return None
+            current = dict(self.current)
+            current["age"] = int(time.time() - self.fetched_at)
+            if self.forecast is not None:
+                temp, wind = self.forecast.get(timestamp)
+                current["temp"] = round(temp, 2)
+                current["wind"] = round(wind, 2)
+        return current
 
 if __name__ == '__main__':
     w = Weather()